@@ -0,0 +1,115 @@
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import Table
+from tribezero import db
+from tribezero.models import User, Post, Shop, CompanyAddress, Listing, Tag, listing_tag
+from tribezero.listings.utils import normalize_tags
+from tribezero.search.utils import rebuild_index
+from tribezero.reference import reference_data
+from tribezero.users.passwords import passwords
+
+
+SCALES = {
+    'small': {'users': 200, 'shops': 50, 'posts': 1000, 'listings': 2000},
+    'medium': {'users': 2000, 'shops': 500, 'posts': 10000, 'listings': 20000},
+    'large': {'users': 20000, 'shops': 5000, 'posts': 100000, 'listings': 200000},
+}
+
+PASSWORD = 'benchmark'
+
+# (city, region, latitude, longitude, weight) - shops cluster around the bigger towns.
+CITIES = [
+    ('Dublin', 'Leinster', 53.3498, -6.2603, 40),
+    ('Cork', 'Munster', 51.8985, -8.4756, 15),
+    ('Galway', 'Connacht', 53.2707, -9.0568, 10),
+    ('Limerick', 'Munster', 52.6638, -8.6267, 8),
+    ('Waterford', 'Munster', 52.2593, -7.1101, 5),
+    ('Kilkenny', 'Leinster', 52.6541, -7.2448, 4),
+    ('Sligo', 'Connacht', 54.2766, -8.4761, 3),
+    ('Athlone', 'Leinster', 53.4239, -7.9407, 3),
+    ('Letterkenny', 'Ulster', 54.9558, -7.7342, 2),
+    ('Tralee', 'Munster', 52.2713, -9.6999, 2),
+]
+
+WORDS = ('organic local bamboo reusable zero waste compost refill soap honey bread coffee tea wool linen '
+         'glass jar cotton bag beeswax wrap candle ceramic mug bottle brush seasonal vegan handmade '
+         'upcycled vintage garden seed market fresh loose bulk grain oat spice oil vinegar').split()
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def insert_in_batches(model_or_table, rows, batch_size=5000):
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if isinstance(model_or_table, Table):
+            db.session.execute(model_or_table.insert(), batch)
+        else:
+            db.session.bulk_insert_mappings(model_or_table, batch)
+    db.session.commit()
+
+
+def generate(scale='small', seed=1):
+    # Seeds an empty database with a deterministic data set. Everything is written with bulk
+    # inserts, so the derived tables (tags, search index) are filled in explicitly afterwards.
+    volumes = SCALES[scale]
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    password = passwords.hash(PASSWORD)
+    categories = [code for code, _ in reference_data.categories]
+
+    insert_in_batches(User, [{'id': user_id, 'username': f'user{user_id:06d}', 'email': f'user{user_id}@example.com',
+                              'password': password, 'image_file': 'default.jpg'}
+                             for user_id in range(1, volumes['users'] + 1)])
+
+    owners = rng.sample(range(1, volumes['users'] + 1), volumes['shops'])
+    shops, addresses = [], []
+    city_weights = [city[4] for city in CITIES]
+    for shop_id, owner in enumerate(owners, start=1):
+        name = f'Shop{shop_id:05d}'
+        shops.append({'id': shop_id, 'name': name, 'name_lower': name.lower(), 'user_id': owner,
+                      'created': now - timedelta(days=rng.randint(0, 700)),
+                      'image_file': 'default_shop.jpg', 'cover_image': 'default_cover.jpg',
+                      'shop_categories': rng.choice(categories), 'description': sentence(rng, 25),
+                      'times_viewed': rng.randint(0, 5000), 'times_favorited': rng.randint(0, 300),
+                      'total_orders': 0, 'total_sales': 0, 'cancelled_sales': 0, 'active_listings': 0,
+                      'inactive_listings': 0, 'expired_listings': 0})
+        city, region, lat, lon, _ = rng.choices(CITIES, weights=city_weights)[0]
+        addresses.append({'id': shop_id, 'shop_id': shop_id, 'company_name': f'Company{shop_id:05d}',
+                          'company_street_line1': f'{rng.randint(1, 200)} Main Street', 'company_street_line2': '',
+                          'company_city': city, 'company_country': 'IE', 'company_zip_code': f'{rng.randint(1, 99):02d}',
+                          'company_region': region,
+                          'company_coordinates_lat': lat + rng.gauss(0, 0.08),
+                          'company_coordinates_lon': lon + rng.gauss(0, 0.12)})
+    insert_in_batches(Shop, shops)
+    insert_in_batches(CompanyAddress, addresses)
+
+    insert_in_batches(Post, [{'id': post_id, 'user_id': rng.randint(1, volumes['users']),
+                              'title': sentence(rng, 5), 'content': sentence(rng, 80),
+                              'date_posted': now - timedelta(minutes=rng.randint(0, 525600))}
+                             for post_id in range(1, volumes['posts'] + 1)])
+
+    # Tag popularity follows a long tail, like real catalogues.
+    tag_names = [f'{word}-{index}' if index else word for index in range(4) for word in WORDS]
+    tag_weights = [1 / (rank + 1) for rank in range(len(tag_names))]
+    listings, postings, counts = [], [], {}
+    for listing_id in range(1, volumes['listings'] + 1):
+        tags = normalize_tags(rng.choices(tag_names, weights=tag_weights, k=rng.randint(1, 5)))
+        listings.append({'id': listing_id, 'name': sentence(rng, 3)[:30], 'tags': tags,
+                         'images': {'image1': 'default_listing.jpg'}, 'shop_id': rng.randint(1, volumes['shops'])})
+        for name in tags:
+            counts[name] = counts.get(name, 0) + 1
+            postings.append((name, listing_id))
+    tag_ids = {name: tag_id for tag_id, name in enumerate(sorted(counts), start=1)}
+    insert_in_batches(Tag, [{'id': tag_id, 'name': name, 'listing_count': counts[name]}
+                            for name, tag_id in tag_ids.items()])
+    insert_in_batches(Listing, listings)
+    insert_in_batches(listing_tag, [{'tag_id': tag_ids[name], 'listing_id': listing_id}
+                                    for name, listing_id in postings])
+
+    rebuild_index()
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute('ANALYZE')
+        db.session.commit()
+    return dict(volumes, tags=len(tag_ids))
@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from tribezero import create_app, db
+from tribezero.config import Config
+from tribezero.counters import counters
+from benchmarks.data import SCALES, PASSWORD, generate
+from benchmarks.scenarios import SCENARIOS, World
+
+
+def benchmark_config(database):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{database}'
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        TESTING = False
+        WTF_CSRF_ENABLED = False
+        BCRYPT_LOG_ROUNDS = 4
+        PASSWORD_HASH_WORKERS = 0
+        GEOCODING_PROVIDER = 'fake'
+        OUTBOX_ASYNC = False
+        STATS_ASYNC = False
+        SLOW_REQUEST_SECONDS = 3600
+        SLOW_REQUEST_QUERIES = 1000000
+    return BenchmarkConfig
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(Engine, 'after_cursor_execute', self)
+
+    def __call__(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return peak_rss_kb()
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+class TestClientDriver:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def login(self, email):
+        self.client.post('/login', data={'email': email, 'password': PASSWORD})
+
+    def get(self, path):
+        response = self.client.get(path)
+        response.close()
+        return response.status_code
+
+
+class ServerDriver:
+    # Talks HTTP to a threaded werkzeug server running the app in this process.
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def login(self, email):
+        self.session.post(self.base_url + '/login', data={'email': email, 'password': PASSWORD})
+
+    def get(self, path):
+        return self.session.get(self.base_url + path).status_code
+
+
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def run_scenario(scenario, make_driver, world, queries, count, warmup, concurrency, seed):
+    rng = random.Random(f'{seed}:{scenario.name}')
+    paths = [scenario.path(rng, world) for _ in range(warmup + count)]
+    drivers = []
+    for _ in range(concurrency):
+        driver = make_driver()
+        if scenario.login:
+            driver.login('user1@example.com')
+        drivers.append(driver)
+
+    for path in paths[:warmup]:
+        drivers[0].get(path)
+
+    latencies, query_counts, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def request(driver, path):
+        before = queries.count
+        started = time.perf_counter()
+        status = driver.get(path)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if concurrency == 1:
+                query_counts.append(queries.count - before)
+
+    measured = paths[warmup:]
+    queries_before = queries.count
+    started = time.perf_counter()
+    if concurrency == 1:
+        for path in measured:
+            request(drivers[0], path)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for index, path in enumerate(measured):
+                pool.submit(request, drivers[index % concurrency], path)
+    duration = time.perf_counter() - started
+    total_queries = queries.count - queries_before
+
+    return {
+        'requests': len(measured),
+        'throughput': len(measured) / duration if duration else None,
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+        'queries_mean': total_queries / len(measured),
+        'queries_max': max(query_counts) if query_counts else None,
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key in ('scale', 'mode', 'concurrency'):
+        if baseline.get('meta', {}).get(key) != results['meta'][key]:
+            print(f'Note: baseline {key} is {baseline.get("meta", {}).get(key)!r}, this run used {results["meta"][key]!r}')
+    print(f'\n{"scenario":<14}{"p95 base":>12}{"p95 now":>12}{"change":>10}{"queries":>14}')
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        change = (current['p95'] - previous['p95']) / previous['p95'] * 100 if previous['p95'] else 0.0
+        queries = f'{previous["queries_mean"]:.1f}->{current["queries_mean"]:.1f}'
+        flag = ''
+        if change > threshold or current['queries_mean'] > previous['queries_mean'] + 0.5:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<14}{previous["p95"] * 1000:>10.1f}ms{current["p95"] * 1000:>10.1f}ms'
+              f'{change:>+9.1f}%{queries:>14}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the TribeZero routes against a generated data set.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario')
+    parser.add_argument('--scenario', action='append', help='run only the named scenarios')
+    parser.add_argument('--server', action='store_true', help='drive a real WSGI server over HTTP')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel clients (with --server)')
+    parser.add_argument('--db', help='SQLite file to use; generated if it does not exist')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed p95 slowdown in percent')
+    args = parser.parse_args(argv)
+    if args.concurrency > 1 and not args.server:
+        parser.error('--concurrency needs --server')
+
+    scratch = None
+    database = args.db
+    if database is None:
+        scratch = tempfile.mkdtemp(prefix='tribezero-bench-')
+        database = os.path.join(scratch, 'bench.db')
+    database = os.path.abspath(database)
+    fresh = not os.path.exists(database)
+
+    app = None
+    try:
+        rss_start = rss_kb()
+        app = create_app(benchmark_config(database))
+        with app.app_context():
+            volumes = None
+            if fresh:
+                db.create_all()
+                started = time.perf_counter()
+                volumes = generate(args.scale, seed=args.seed)
+                print(f'Generated {volumes} in {time.perf_counter() - started:.1f}s')
+            world = World()
+        rss_loaded = rss_kb()
+
+        queries = QueryCounter()
+        server = None
+        if args.server:
+            server, base_url = start_server(app)
+            make_driver = lambda: ServerDriver(base_url)
+        else:
+            make_driver = lambda: TestClientDriver(app)
+
+        scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario.name in args.scenario]
+        results = {
+            'meta': {'revision': git_revision(), 'timestamp': datetime.utcnow().isoformat(),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'scale': args.scale, 'seed': args.seed, 'volumes': volumes,
+                     'mode': 'server' if args.server else 'test_client', 'concurrency': args.concurrency,
+                     'requests': args.requests, 'warmup': args.warmup},
+            'scenarios': {},
+        }
+        print(f'{"scenario":<14}{"p50":>9}{"p95":>9}{"p99":>9}{"req/s":>9}{"queries":>9}')
+        for scenario in scenarios:
+            result = run_scenario(scenario, make_driver, world, queries, args.requests, args.warmup,
+                                  args.concurrency, args.seed)
+            results['scenarios'][scenario.name] = result
+            print(f'{scenario.name:<14}{result["p50"] * 1000:>7.1f}ms{result["p95"] * 1000:>7.1f}ms'
+                  f'{result["p99"] * 1000:>7.1f}ms{result["throughput"]:>9.0f}{result["queries_mean"]:>9.1f}'
+                  + ('' if set(result['statuses']) <= {'200'} else f'  statuses {result["statuses"]}'))
+        if server is not None:
+            server.shutdown()
+
+        results['rss_kb'] = {'start': rss_start, 'loaded': rss_loaded, 'end': rss_kb(), 'peak': peak_rss_kb()}
+        print(f'RSS: {results["rss_kb"]["end"] / 1024:.0f} MB, peak {results["rss_kb"]["peak"] / 1024:.0f} MB')
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'Wrote {args.output}')
+        if args.compare:
+            with open(args.compare) as f:
+                regressions = compare(results, json.load(f), args.threshold)
+            if regressions:
+                print(f'Regressions: {", ".join(regressions)}')
+                return 1
+        return 0
+    finally:
+        if app is not None:
+            # Write buffered view counts now, while the scratch database still exists.
+            with app.app_context():
+                counters.flush()
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
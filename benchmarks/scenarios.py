@@ -0,0 +1,78 @@
+import math
+from collections import namedtuple
+from tribezero.models import Post, Shop, Tag
+from tribezero.posts.feed import encode_cursor
+from tribezero.reference import reference_data
+from benchmarks.data import CITIES, WORDS
+
+
+# `path` builds the URL for one request from a random generator and the World; scenarios with
+# `login` set are run by a client that has signed in first.
+Scenario = namedtuple('Scenario', 'name path login')
+
+
+class World:
+    # Ids and names the scenarios pick from, loaded once after the data has been generated.
+
+    def __init__(self):
+        self.shop_names = [name for (name,) in Shop.query.with_entities(Shop.name).order_by(Shop.id)]
+        self.post_ids = [post_id for (post_id,) in Post.query.with_entities(Post.id).order_by(Post.id)]
+        self.cursors = [encode_cursor(post) for post in
+                        Post.query.order_by(Post.date_posted.desc()).limit(200)]
+        self.tags = [name for (name,) in Tag.query.with_entities(Tag.name).order_by(Tag.listing_count.desc()).limit(50)]
+        self.categories = [code for code, _ in reference_data.categories]
+        self.shop_pages = max(1, math.ceil(len(self.shop_names) / 10))
+
+
+def tile_for(lat, lon, zoom):
+    scale = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * scale)
+    siny = math.sin(math.radians(lat))
+    y = int((0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * scale)
+    return zoom, x, y
+
+
+def city_point(rng):
+    _, _, lat, lon, _ = rng.choice(CITIES)
+    return lat + rng.gauss(0, 0.05), lon + rng.gauss(0, 0.05)
+
+
+def map_tile(rng, world):
+    lat, lon = city_point(rng)
+    return '/map/tiles/%d/%d/%d' % tile_for(lat, lon, rng.randint(6, 12))
+
+
+def map_bbox(rng, world):
+    lat, lon = city_point(rng)
+    span = rng.choice((0.1, 0.5, 2.0))
+    return f'/map/shops?south={lat - span}&west={lon - span}&north={lat + span}&east={lon + span}'
+
+
+def nearby(rng, world):
+    lat, lon = city_point(rng)
+    category = f'&category={rng.choice(world.categories)}' if rng.random() < 0.3 else ''
+    return f'/nearby/shops?lat={lat}&lon={lon}&radius={rng.choice((5, 25, 100))}{category}'
+
+
+def listings(rng, world):
+    params = [f'tag={tag}' for tag in rng.sample(world.tags, rng.randint(0, 2))]
+    if rng.random() < 0.3:
+        params.append(f'category={rng.choice(world.categories)}')
+    return '/listings?' + '&'.join(params)
+
+
+SCENARIOS = [
+    Scenario('home', lambda rng, world: '/home', False),
+    Scenario('blog', lambda rng, world: '/blog', False),
+    Scenario('blog_older', lambda rng, world: f'/blog?before={rng.choice(world.cursors)}', False),
+    Scenario('post', lambda rng, world: f'/post/{rng.choice(world.post_ids)}', False),
+    Scenario('shop', lambda rng, world: f'/shop/{rng.choice(world.shop_names)}', False),
+    Scenario('shops', lambda rng, world: f'/shops?page={rng.randint(1, world.shop_pages)}', False),
+    Scenario('sellers_map', lambda rng, world: '/map', False),
+    Scenario('map_tiles', map_tile, False),
+    Scenario('map_shops', map_bbox, False),
+    Scenario('nearby', nearby, False),
+    Scenario('listings', listings, False),
+    Scenario('search', lambda rng, world: f'/search?q={rng.choice(WORDS)}', False),
+    Scenario('account', lambda rng, world: '/account', True),
+]
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter so nothing is already imported; the timing covers what a new
+# worker process pays before it can serve its first request.
+COLD_START = '''
+import time
+started = time.perf_counter()
+from tribezero import create_app
+app = create_app()
+print(time.perf_counter() - started)
+'''
+
+
+def parse_importtime(output):
+    # `python -X importtime` writes one line per module: self and cumulative microseconds, then
+    # the module name indented by its depth in the import stack.
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us), len(name) - len(name.lstrip())))
+    return modules
+
+
+def cold_start():
+    # The interpreter starts outside the repository so relative paths can't hide in the timing.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', COLD_START], cwd=cwd, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise SystemExit(result.stderr)
+    return float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def profile(runs):
+    wall, self_times, cumulative_times, packages = [], defaultdict(list), defaultdict(list), defaultdict(list)
+    for _ in range(runs):
+        seconds, modules = cold_start()
+        wall.append(seconds)
+        per_package = defaultdict(int)
+        for name, self_us, cumulative_us, depth in modules:
+            self_times[name].append(self_us)
+            cumulative_times[name].append(cumulative_us)
+            per_package[name.split('.')[0]] += self_us
+        for package, total in per_package.items():
+            packages[package].append(total)
+    median = lambda values: statistics.median(values) / 1000
+    return {
+        'runs': runs,
+        'wall_ms': {'median': statistics.median(wall) * 1000, 'min': min(wall) * 1000, 'max': max(wall) * 1000},
+        'modules': len(self_times),
+        'packages': {package: median(values) for package, values in packages.items()},
+        'self_ms': {name: median(values) for name, values in self_times.items()},
+        'cumulative_ms': {name: median(values) for name, values in cumulative_times.items()},
+    }
+
+
+def top(mapping, count):
+    return sorted(mapping.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def report(results, count):
+    wall = results['wall_ms']
+    print(f'Cold start (import tribezero + create_app): median {wall["median"]:.0f} ms, '
+          f'min {wall["min"]:.0f} ms, max {wall["max"]:.0f} ms over {results["runs"]} runs; '
+          f'{results["modules"]} modules imported')
+    print(f'\n{"package":<32}{"import ms":>10}')
+    for package, ms in top(results['packages'], count):
+        print(f'{package:<32}{ms:>10.1f}')
+    print(f'\n{"module":<48}{"self ms":>10}{"cumul. ms":>11}')
+    for name, ms in top(results['cumulative_ms'], count):
+        print(f'{name:<48}{results["self_ms"][name]:>10.1f}{ms:>11.1f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile the imports a fresh TribeZero worker performs.')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts to take the median of')
+    parser.add_argument('--top', type=int, default=20, help='packages and modules to list')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    results = profile(args.runs)
+    report(results, args.top)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Wrote {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        before, after = baseline['wall_ms']['median'], results['wall_ms']['median']
+        print(f'\nCold start {before:.0f} ms -> {after:.0f} ms ({(after - before) / before * 100:+.1f}%)')
+        gone = sorted(set(baseline['packages']) - set(results['packages']))
+        if gone:
+            print(f'No longer imported at startup: {", ".join(gone)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
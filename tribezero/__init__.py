@@ -1,13 +1,11 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_mail import Mail
 from tribezero.config import Config
+from tribezero.database import Database
 
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()
+db = Database()
 login_manager = LoginManager()
 login_manager.login_view = 'users.login'
 login_manager.login_message_category = 'info'
@@ -16,23 +14,77 @@ mail = Mail()
 
 def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
 
     db.init_app(app)
-    bcrypt.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
 
+    from tribezero.geo.index import shop_index
+    from tribezero.geo.clusters import tile_cache
+    from tribezero.geo.geocoding import geocoder
+    from tribezero.users.identity import identity_cache
+    from tribezero.users.passwords import passwords
+    from tribezero.outbox import outbox
+    from tribezero.images import images
+    from tribezero.shops.stats import shop_stats
+    from tribezero.counters import counters
+    from tribezero.instrumentation import instrumentation
+    from tribezero.caching import cache
+    from tribezero.shops.typeahead import shop_typeahead
+    from tribezero.listings.imports import listing_importer
+    from tribezero.ledger import ledger
+    from tribezero.ratelimit import limiter
+
+    shop_index.init_app(app)
+    tile_cache.init_app(app)
+    geocoder.init_app(app)
+    identity_cache.init_app(app)
+    passwords.init_app(app)
+    outbox.init_app(app)
+    images.init_app(app)
+    shop_stats.init_app(app)
+    counters.init_app(app)
+    instrumentation.init_app(app)
+    cache.init_app(app)
+    shop_typeahead.init_app(app)
+    listing_importer.init_app(app)
+    ledger.init_app(app)
+    limiter.init_app(app)
+
+    from tribezero.commands import upgrade_db
+    from tribezero.geo.commands import geo_cli
+    from tribezero.search.utils import search_cli
+    from tribezero.outbox import outbox_cli
+    from tribezero.images import images_cli
+    from tribezero.shops.stats import stats_cli
+    from tribezero.listings.imports import listings_cli
+    from tribezero.ledger import ledger_cli
+    app.cli.add_command(upgrade_db)
+    app.cli.add_command(geo_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(outbox_cli)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(listings_cli)
+    app.cli.add_command(ledger_cli)
+
     from tribezero.users.routes import users
     from tribezero.posts.routes import posts
     from tribezero.shops.routes import user_shops
     from tribezero.main.routes import main
+    from tribezero.search.routes import search
+    from tribezero.listings.routes import listings
+    from tribezero.admin.routes import admin
     from tribezero.errors.handlers import errors
 
     app.register_blueprint(users)
     app.register_blueprint(posts)
     app.register_blueprint(user_shops)
     app.register_blueprint(main)
+    app.register_blueprint(search)
+    app.register_blueprint(listings)
+    app.register_blueprint(admin)
     app.register_blueprint(errors)
 
     return app
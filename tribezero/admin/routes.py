@@ -0,0 +1,15 @@
+from flask import Blueprint, Response
+from tribezero.admin.utils import admin_required
+from tribezero.instrumentation import instrumentation
+from tribezero.users.passwords import passwords
+from tribezero.ratelimit import limiter
+
+
+admin = Blueprint('admin', __name__)
+
+
+@admin.route("/admin/metrics")
+@admin_required
+def metrics():
+    lines = instrumentation.render() + passwords.render() + limiter.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,13 @@
+from functools import wraps
+from flask import abort, current_app
+from flask_login import current_user
+
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or \
+                current_user.email not in current_app.config.get('ADMIN_EMAILS', ()):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
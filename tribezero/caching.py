@@ -0,0 +1,330 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from stat import S_ISREG
+from flask import current_app, request, session, make_response, Response
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+from tribezero.database import primary, replica_allowed
+from tribezero.hooks import on_commit
+from tribezero.models import Post, Shop, User
+
+
+CachedPage = namedtuple('CachedPage', ['body', 'status', 'mimetype', 'etag', 'last_modified'])
+
+
+class MemoryBackend:
+    # Per-process LRU. Tag invalidations only reach this process, so use the file backend when
+    # several workers serve the same site.
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileBackend:
+    # One pickle per key under `directory`, written atomically, so every worker on the host shares
+    # entries and tag versions. Expired files are removed when they are next read.
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((time.time() + ttl if ttl else None, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                try:
+                    os.remove(os.path.join(root, filename))
+                except OSError:
+                    pass
+
+
+class NullBackend:
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class FragmentCacheExtension(Extension):
+    # {% cache 'name', ['tag', ...], vary... %}...{% endcache %} caches the rendered block under
+    # the name, the vary values and the request locale until a tag is invalidated.
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        name, tags, *vary = args
+        return cache.fragment(name, tags, vary, caller)
+
+
+class Cache:
+    # Response and fragment cache. Every entry is stored with the versions of the tags it depends
+    # on; invalidating a tag gives it a new version, so entries that saw the old one are ignored
+    # from then on without having to find and delete them. Whole pages are only cached for
+    # anonymous visitors without pending flash messages, and are always filled from the primary.
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self._static_versions = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_DIR', os.path.join(app.instance_path, 'cache'))
+        app.config.setdefault('CACHE_MAX_ENTRIES', 2048)
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_LANGUAGES', ['en'])
+        app.config.setdefault('STATIC_CACHE_MAX_AGE', 365 * 24 * 3600)
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'memory':
+            self.backend = MemoryBackend(app.config['CACHE_MAX_ENTRIES'])
+        elif backend == 'file':
+            self.backend = FileBackend(app.config['CACHE_DIR'])
+        elif backend == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND {backend!r}')
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.url_defaults(self._static_url_defaults)
+        app.after_request(self._static_cache_headers)
+
+    def tag_versions(self, tags):
+        versions = {}
+        for tag in tags:
+            version = self.backend.get(f'tag:{tag}')
+            if version is None:
+                version = uuid.uuid4().hex
+                self.backend.set(f'tag:{tag}', version)
+            versions[tag] = version
+        return versions
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.set(f'tag:{tag}', uuid.uuid4().hex)
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        versions, value = entry
+        for tag, version in versions.items():
+            if self.backend.get(f'tag:{tag}') != version:
+                return None
+        return value
+
+    def set(self, key, value, versions=None, ttl=None):
+        # `versions` should be read with tag_versions() before the value was computed, so a change
+        # committed while it was being built still invalidates it.
+        self.backend.set(key, (versions or {}, value), ttl or current_app.config['CACHE_DEFAULT_TTL'])
+
+    def locale(self):
+        languages = current_app.config['CACHE_LANGUAGES']
+        return request.accept_languages.best_match(languages) or languages[0]
+
+    def fragment(self, name, tags, vary, render):
+        if isinstance(tags, str):
+            tags = [tags]
+        key = 'fragment:' + '|'.join([name, self.locale()] + [str(value) for value in vary])
+        html = self.get(key)
+        if html is None:
+            versions = self.tag_versions(tags)
+            html = render()
+            ttl = current_app.config['CACHE_DEFAULT_TTL']
+            if replica_allowed():
+                # The data came from the replica and may predate an invalidation that's already
+                # been applied, so keep the fragment no longer than the replica is trusted to lag.
+                ttl = min(ttl, current_app.config['DATABASE_REPLICA_STICKY_SECONDS'])
+            self.set(key, str(html), versions, ttl)
+        return Markup(html)
+
+    def _cacheable(self):
+        return request.method in ('GET', 'HEAD') and not isinstance(self.backend, NullBackend) \
+            and not current_user.is_authenticated and '_flashes' not in session
+
+    def page_key(self):
+        return f'page:{self.locale()}:{current_user.get_id() or "-"}:{request.url}'
+
+    def page(self, tags=(), ttl=None):
+        # Caches the view's response body for anonymous visitors; everyone gets an ETag and 304s.
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if not self._cacheable():
+                    return conditional_response(make_response(f(*args, **kwargs)), private=True)
+                key = self.page_key()
+                page = self.get(key)
+                if page is None:
+                    versions = self.tag_versions(tags)
+                    with primary():
+                        response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough or session.modified:
+                        return conditional_response(response)
+                    body = response.get_data()
+                    page = CachedPage(body, response.status_code, response.mimetype,
+                                      hashlib.sha1(body).hexdigest(), time.time())
+                    self.set(key, page, versions, ttl)
+                response = Response(page.body, status=page.status, mimetype=page.mimetype)
+                response.set_etag(page.etag)
+                response.headers['Last-Modified'] = http_date(page.last_modified)
+                return conditional_response(response)
+            return decorated_function
+        return decorator
+
+    def static_version(self, filename):
+        path = safe_join(current_app.static_folder, filename)
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        # Only regular files are fingerprinted: a directory prefix such as 'marker_icons/' has
+        # file names appended to it in JavaScript, where a query string would end up in the middle.
+        if stat is None or not S_ISREG(stat.st_mode):
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._static_versions.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        version = digest.hexdigest()[:12]
+        with self._lock:
+            self._static_versions[path] = (signature, version)
+        return version
+
+    def _static_url_defaults(self, endpoint, values):
+        # url_for('static', ...) gains ?v=<content hash>, so the file can be cached forever and a
+        # changed file gets a new URL.
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            version = self.static_version(values['filename'])
+            if version is not None:
+                values['v'] = version
+
+    def _static_cache_headers(self, response):
+        if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+            response.headers['Cache-Control'] = f'public, max-age={current_app.config["STATIC_CACHE_MAX_AGE"]}, immutable'
+            response.headers.pop('Expires', None)
+        return response
+
+
+def conditional_response(response, private=False):
+    # Adds an ETag when the view didn't set one, answers If-None-Match/If-Modified-Since with 304
+    # and asks browsers to revalidate rather than reuse the page blindly.
+    if request.method in ('GET', 'HEAD') and response.status_code == 200 and not response.direct_passthrough:
+        if response.get_etag()[0] is None:
+            response.add_etag()
+        response.headers['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+        response.vary.update(('Cookie', 'Accept-Language'))
+        response.make_conditional(request)
+    return response
+
+
+def conditional(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        return conditional_response(make_response(f(*args, **kwargs)), private=current_user.is_authenticated)
+    return decorated_function
+
+
+cache = Cache()
+
+
+@on_commit(Post)
+def _posts_changed(post_ids):
+    cache.invalidate('post', *(f'post:{post_id}' for post_id in post_ids))
+
+
+@on_commit(Shop)
+def _shops_changed(shop_ids):
+    cache.invalidate('shop', *(f'shop:{shop_id}' for shop_id in shop_ids))
+
+
+@on_commit(User)
+def _users_changed(user_ids):
+    cache.invalidate('user', *(f'user:{user_id}' for user_id in user_ids))
@@ -0,0 +1,55 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from tribezero import db
+from tribezero.models import Shop
+from tribezero.listings.utils import backfill_listing_tags
+
+
+def backfill_shop_name_lower():
+    count = 0
+    for shop in Shop.query.filter(Shop.name_lower.is_(None)):
+        shop.name_lower = shop.name.lower()
+        count += 1
+    return count
+
+
+# Run in order after missing columns have been added and before indexes are created,
+# so unique indexes on new columns are built over backfilled values.
+DATA_MIGRATIONS = [backfill_shop_name_lower, backfill_listing_tags]
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db():
+    """Create missing tables, columns and indexes and backfill new columns."""
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    missing = []
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing += [(table, column) for column in table.columns if column.name not in existing]
+    # Existing rows would have no value for a NOT NULL column, so those need a hand-written migration.
+    required = [f'{table.name}.{column.name}' for table, column in missing if not column.nullable]
+    if required:
+        raise click.ClickException(f'Cannot add NOT NULL columns automatically: {", ".join(required)}.')
+    for table, column in missing:
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        db.session.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+        click.echo(f'Added column {table.name}.{column.name}.')
+    db.session.commit()
+
+    for migration in DATA_MIGRATIONS:
+        count = migration()
+        db.session.commit()
+        if count:
+            click.echo(f'{migration.__name__}: {count} rows updated.')
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                click.echo(f'Created index {index.name}.')
+    click.echo('Database is up to date.')
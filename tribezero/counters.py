@@ -0,0 +1,116 @@
+import atexit
+import threading
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import func
+from tribezero import db
+
+
+class Counters:
+    # Write-behind buffer for hot integer counters such as Shop.times_viewed. Increments are
+    # summed in memory per process and flushed every COUNTER_FLUSH_INTERVAL seconds (and at
+    # exit) as one UPDATE per row, `SET col = col + n`, in its own short transaction. Nothing
+    # reads the row first, so concurrent processes never overwrite each other's counts. Rows
+    # appended for hot paths, such as shop view events, are inserted in bulk by the same flush.
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._rows = defaultdict(list)
+        self._worker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COUNTER_FLUSH_INTERVAL', 10)
+        app.config.setdefault('COUNTER_ASYNC', True)
+
+    def incr(self, column, key, n=1, by=None):
+        # `column` is a mapped attribute (Shop.times_viewed); the row is found by primary key
+        # unless `by` names another column, e.g. TransactionHistory.user_id.
+        by = by if by is not None else column.class_.id
+        with self._lock:
+            self._pending[(column.class_.__table__, by.key, key, column.key)] += n
+        self._flush_later()
+
+    def append(self, table, row):
+        # Appended rows reach the database up to COUNTER_FLUSH_INTERVAL later. A value that must
+        # reflect when the row is written, such as a timestamp something orders or lags on, is
+        # given as a callable and filled in by the flush, just before the insert.
+        with self._lock:
+            self._rows[table].append(row)
+        self._flush_later()
+
+    def _flush_later(self):
+        if current_app.config['COUNTER_ASYNC']:
+            self._ensure_worker(current_app._get_current_object())
+        else:
+            self.flush()
+
+    def pending(self, column, key, by=None):
+        by = by if by is not None else column.class_.id
+        with self._lock:
+            return self._pending.get((column.class_.__table__, by.key, key, column.key), 0)
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            appended, self._rows = self._rows, defaultdict(list)
+        return pending, appended
+
+    def _restore(self, pending, appended):
+        with self._lock:
+            for counter, n in pending.items():
+                self._pending[counter] += n
+            for table, rows in appended.items():
+                self._rows[table][:0] = rows
+
+    def flush(self):
+        pending, appended = self._take()
+        if not pending and not appended:
+            return 0
+        rows = defaultdict(dict)
+        for (table, by, key, column), n in pending.items():
+            if n:
+                rows[(table, by, key)][column] = n
+        try:
+            with db.engine.begin() as connection:
+                for (table, by, key), increments in rows.items():
+                    values = {column: func.coalesce(table.c[column], 0) + n for column, n in increments.items()}
+                    connection.execute(table.update().where(table.c[by] == key).values(values))
+                for table, inserts in appended.items():
+                    connection.execute(table.insert(), [
+                        {column: value() if callable(value) else value for column, value in row.items()}
+                        for row in inserts])
+        except Exception:
+            self._restore(pending, appended)
+            raise
+        return len(rows) + sum(map(len, appended.values()))
+
+    def _ensure_worker(self, app):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, args=(app,), name='counters', daemon=True)
+                self._worker.start()
+                atexit.register(self._flush_at_exit, app)
+
+    def _work(self, app):
+        while True:
+            threading.Event().wait(app.config['COUNTER_FLUSH_INTERVAL'])
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception('Counter flush failed')
+
+    def _flush_at_exit(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Counter flush at exit failed')
+
+
+counters = Counters()
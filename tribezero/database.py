@@ -0,0 +1,160 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, g, has_app_context, has_request_context, session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.sql.expression import SelectBase
+
+
+REPLICA = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    # Sends reads to the 'replica' bind while a view marked with @replica_reads is running,
+    # unless this transaction has already written, the block runs under primary(), or the
+    # visitor committed something within the last DATABASE_REPLICA_STICKY_SECONDS.
+    # Anything that isn't a SELECT always goes to the primary.
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if clause is not None and not isinstance(clause, SelectBase):
+            return super().get_bind(mapper, clause)
+        if not self._flushing and not self.info.get('tribezero_wrote') and replica_allowed():
+            info = getattr(mapper.persist_selectable, 'info', {}) if mapper is not None else {}
+            if info.get('bind_key') is None:
+                return self.db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+def replica_allowed():
+    if not has_request_context() or not g.get('db_replica_reads') or g.get('db_force_primary'):
+        return False
+    if REPLICA not in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    return cookie_session.get('db_primary_until', 0) < time.time()
+
+
+def replica_reads(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_replica_reads = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.pop('db_replica_reads', None)
+    return decorated_function
+
+
+@contextmanager
+def primary():
+    # Forces the primary inside the block, e.g. while filling caches that commits invalidate;
+    # filling them from a lagging replica would undo the invalidation.
+    if not has_app_context():
+        yield
+        return
+    g.db_force_primary = g.get('db_force_primary', 0) + 1
+    try:
+        yield
+    finally:
+        g.db_force_primary -= 1
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['tribezero_wrote'] = True
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(getattr(obj, '__sticky_writes__', True) for obj in changed):
+        session.info['tribezero_sticky'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(session):
+    session.info.pop('tribezero_wrote', None)
+    if session.info.pop('tribezero_sticky', None) and has_request_context() \
+            and REPLICA in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        cookie_session['db_primary_until'] = time.time() + current_app.config['DATABASE_REPLICA_STICKY_SECONDS']
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_writes(session):
+    session.info.pop('tribezero_wrote', None)
+    session.info.pop('tribezero_sticky', None)
+
+
+def sqlite_pragmas(journal_mode, synchronous, busy_timeout, mmap_size):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+        if journal_mode:
+            cursor.execute(f'PRAGMA journal_mode = {journal_mode}')
+        if synchronous:
+            cursor.execute(f'PRAGMA synchronous = {synchronous}')
+        if mmap_size:
+            cursor.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        cursor.close()
+    return set_pragmas
+
+
+class Database(SQLAlchemy):
+    # Flask-SQLAlchemy with tuned engine defaults and replica routing. Server databases get a
+    # sized, pre-pinged connection pool; SQLite files get a small pool of connections set up for
+    # concurrent readers and a writer (WAL, synchronous=NORMAL, busy_timeout, mmap).
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_POOL_SIZE', 10)
+        app.config.setdefault('DATABASE_MAX_OVERFLOW', 20)
+        app.config.setdefault('DATABASE_POOL_TIMEOUT', 30)
+        app.config.setdefault('DATABASE_POOL_RECYCLE', 1800)
+        app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+        app.config.setdefault('SQLITE_POOL_SIZE', 5)
+        app.config.setdefault('SQLITE_JOURNAL_MODE', 'wal')
+        app.config.setdefault('SQLITE_SYNCHRONOUS', 'normal')
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+        app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+        app.config.setdefault('DATABASE_REPLICA_URI', None)
+        app.config.setdefault('DATABASE_REPLICA_STICKY_SECONDS', 10)
+        if app.config['DATABASE_REPLICA_URI']:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.setdefault(REPLICA, app.config['DATABASE_REPLICA_URI'])
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super().init_app(app)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        config = app.config
+        if sa_url.drivername.startswith('sqlite'):
+            # In-memory databases keep their single StaticPool connection. For files, a pool
+            # replaces Flask-SQLAlchemy's NullPool so the pragmas and page cache survive requests.
+            if options.get('poolclass') is StaticPool or options.get('pool_size') == 0:
+                return
+            options['poolclass'] = QueuePool
+            options.setdefault('pool_size', config['SQLITE_POOL_SIZE'])
+            options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', config['DATABASE_POOL_TIMEOUT'])
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        else:
+            options.setdefault('pool_size', config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', config['DATABASE_POOL_TIMEOUT'])
+            options.setdefault('pool_recycle', config['DATABASE_POOL_RECYCLE'])
+            options.setdefault('pool_pre_ping', config['DATABASE_POOL_PRE_PING'])
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            config = self.get_app().config
+            memory = sa_url.database in (None, '', ':memory:')
+            event.listen(engine, 'connect', sqlite_pragmas(
+                journal_mode=None if memory else config['SQLITE_JOURNAL_MODE'],
+                synchronous=config['SQLITE_SYNCHRONOUS'],
+                busy_timeout=config['SQLITE_BUSY_TIMEOUT'],
+                mmap_size=None if memory else config['SQLITE_MMAP_SIZE']))
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
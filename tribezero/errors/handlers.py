@@ -13,7 +13,17 @@ def error_403(error):
     return render_template('errors/403.html'), 403
 
 
+@errors.app_errorhandler(429)
+def error_429(error):
+    headers = {'Retry-After': str(error.retry_after)} if getattr(error, 'retry_after', None) else {}
+    return render_template('errors/429.html'), 429, headers
+
+
 @errors.app_errorhandler(500)
 def error_500(error):
     return render_template('errors/500.html'), 500
 
+
+@errors.app_errorhandler(503)
+def error_503(error):
+    return render_template('errors/503.html'), 503, {'Retry-After': '5'}
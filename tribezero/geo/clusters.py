@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from tribezero.hooks import on_commit
+from tribezero.geo.index import shop_index
+from tribezero.models import Shop, CompanyAddress
+
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798
+
+
+def world_pixel(lat, lon, zoom):
+    # Web Mercator pixel coordinates of a point, as used by Google Maps tiles.
+    scale = TILE_SIZE * 2 ** zoom
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return min(x, scale - 1), min(y, scale - 1)
+
+
+def tile_bounds(zoom, x, y):
+    n = 2 ** zoom
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def cluster_tile(zoom, x, y, cell_pixels=64, max_zoom=16):
+    # Buckets the shops of one tile into cell_pixels squares and returns a centroid and count
+    # per bucket. Buckets holding a single shop, and every shop past max_zoom, are returned as-is.
+    south, west, north, east = tile_bounds(zoom, x, y)
+    markers, _ = shop_index.query_bbox(south, west, north, east)
+    buckets = {}
+    for marker in markers:
+        px, py = world_pixel(marker.lat, marker.lon, zoom)
+        if int(px // TILE_SIZE) != x or int(py // TILE_SIZE) != y:
+            continue
+        if zoom >= max_zoom:
+            cell = marker.id
+        else:
+            cell = int(px // cell_pixels), int(py // cell_pixels)
+        buckets.setdefault(cell, []).append(marker)
+
+    clusters = []
+    shops = []
+    for members in buckets.values():
+        if len(members) == 1:
+            shops.append(members[0]._asdict())
+            continue
+        clusters.append({'lat': sum(m.lat for m in members) / len(members),
+                         'lon': sum(m.lon for m in members) / len(members),
+                         'count': len(members)})
+    return {'zoom': zoom, 'x': x, 'y': y, 'clusters': clusters, 'shops': shops}
+
+
+class TileCache:
+    # LRU of computed tiles with a per-entry TTL. Every change to a shop or its address clears
+    # the cache; the generation counter stops a tile computed before the change from being stored.
+
+    def __init__(self, app=None):
+        self.max_size = 2048
+        self.ttl = 600
+        self.cell_pixels = 64
+        self.max_zoom = 16
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()
+        self._generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.setdefault('MAP_TILE_CACHE_SIZE', 2048)
+        self.ttl = app.config.setdefault('MAP_TILE_CACHE_TTL', 600)
+        self.cell_pixels = app.config.setdefault('MAP_CLUSTER_CELL_PIXELS', 64)
+        self.max_zoom = app.config.setdefault('MAP_CLUSTER_MAX_ZOOM', 16)
+
+    def get(self, zoom, x, y):
+        key = (zoom, x, y)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is not None and entry[0] > now:
+                self._tiles.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+
+        tile = cluster_tile(zoom, x, y, cell_pixels=self.cell_pixels, max_zoom=self.max_zoom)
+
+        with self._lock:
+            if generation == self._generation:
+                self._tiles[key] = (now + self.ttl, tile)
+                self._tiles.move_to_end(key)
+                while len(self._tiles) > self.max_size:
+                    self._tiles.popitem(last=False)
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._generation += 1
+
+
+tile_cache = TileCache()
+
+
+@on_commit(Shop)
+def _shops_changed(shop_ids):
+    tile_cache.clear()
+
+
+@on_commit(CompanyAddress, key=lambda address: address.shop_id)
+def _addresses_changed(shop_ids):
+    tile_cache.clear()
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import or_
+from tribezero import db
+from tribezero.models import CompanyAddress, GeocodedAddress
+from tribezero.reference import reference_data
+from tribezero.geo.geocoding import geocoder, normalize_address, address_string, GeocodingError
+
+
+geo_cli = AppGroup('geo', help='Geocoding and map maintenance.')
+
+
+class RateLimiter:
+    # Spaces calls at least 1/rate seconds apart across all threads.
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('last_id', 0)
+
+
+def save_checkpoint(path, last_id):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'last_id': last_id, 'saved': datetime.utcnow().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+def address_batches(after_id, batch_size, include_geocoded):
+    query = CompanyAddress.query
+    if not include_geocoded:
+        query = query.filter(or_(CompanyAddress.company_coordinates_lat.is_(None),
+                                 CompanyAddress.company_coordinates_lon.is_(None)))
+    while True:
+        batch = query.filter(CompanyAddress.id > after_id).order_by(CompanyAddress.id).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1].id
+
+
+@geo_cli.command('backfill')
+@click.option('--batch-size', default=500, show_default=True, help='Rows written per commit.')
+@click.option('--workers', default=8, show_default=True, help='Concurrent geocoding requests.')
+@click.option('--rate', default=25.0, show_default=True, help='Maximum provider requests per second.')
+@click.option('--stale-days', type=int, default=None,
+              help='Also re-geocode addresses whose cached result is older than this many days.')
+@click.option('--checkpoint', default=None, help='Progress file; defaults to the instance folder.')
+@click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and start from the first row.')
+def backfill(batch_size, workers, rate, stale_days, checkpoint, restart):
+    """Geocode CompanyAddress rows that have no (or stale) coordinates."""
+    countries = reference_data.country_names
+    checkpoint = checkpoint or os.path.join(current_app.instance_path, 'geocode_backfill.json')
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    last_id = 0 if restart else load_checkpoint(checkpoint)
+    stale_before = datetime.utcnow() - timedelta(days=stale_days) if stale_days is not None else None
+    limiter = RateLimiter(rate)
+
+    def geocode(address):
+        limiter.wait()
+        try:
+            return address, geocoder.provider.geocode(address), None
+        except GeocodingError as e:
+            return address, None, e
+
+    if last_id:
+        click.echo(f'Resuming after CompanyAddress {last_id}.')
+    updated = looked_up = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in address_batches(last_id, batch_size, include_geocoded=stale_before is not None):
+            rows_by_key = {}
+            addresses = {}
+            for row in batch:
+                address = address_string(row, countries.get(row.company_country))
+                key = normalize_address(address)
+                rows_by_key.setdefault(key, []).append(row)
+                addresses.setdefault(key, address)
+
+            cached = {entry.address: entry for entry in
+                      GeocodedAddress.query.filter(GeocodedAddress.address.in_(list(rows_by_key)))}
+            results = {}
+            misses = []
+            for key, address in addresses.items():
+                entry = cached.get(key)
+                if entry is not None and (stale_before is None or entry.updated >= stale_before):
+                    if entry.lat is not None:
+                        results[key] = (entry.lat, entry.lon)
+                else:
+                    misses.append(address)
+
+            for address, coordinates, error in pool.map(geocode, misses):
+                key = normalize_address(address)
+                if error is not None:
+                    failed += len(rows_by_key[key])
+                    current_app.logger.warning('Geocoding %r failed: %s', address, error)
+                    continue
+                looked_up += 1
+                entry = cached.get(key) or GeocodedAddress(address=key)
+                entry.lat, entry.lon = coordinates if coordinates else (None, None)
+                entry.provider = geocoder.provider.name
+                entry.updated = datetime.utcnow()
+                db.session.add(entry)
+                if coordinates:
+                    results[key] = coordinates
+
+            for key, coordinates in results.items():
+                for row in rows_by_key[key]:
+                    if (row.company_coordinates_lat, row.company_coordinates_lon) != coordinates:
+                        row.company_coordinates_lat, row.company_coordinates_lon = coordinates
+                        updated += 1
+
+            last_id = batch[-1].id
+            db.session.commit()
+            save_checkpoint(checkpoint, last_id)
+            click.echo(f'Up to CompanyAddress {last_id}: {updated} updated, '
+                       f'{looked_up} looked up, {failed} failed.')
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    click.echo(f'Done: {updated} addresses updated, {looked_up} provider lookups, {failed} failed.')
@@ -0,0 +1,223 @@
+import hashlib
+import itertools
+import queue
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from tribezero import db
+from tribezero.models import CompanyAddress, GeocodedAddress
+from tribezero.reference import reference_data
+
+
+class GeocodingError(Exception):
+    pass
+
+
+def normalize_address(address):
+    address = re.sub(r'[^\w,]+', ' ', address.lower())
+    parts = [' '.join(part.split()) for part in address.split(',')]
+    return ','.join(part for part in parts if part)
+
+
+def address_string(company_address, country_name=None):
+    return ','.join([company_address.company_street_line1,
+                     company_address.company_street_line2 or '',
+                     company_address.company_city,
+                     company_address.company_region,
+                     company_address.company_zip_code,
+                     country_name or company_address.company_country])
+
+
+class GeocodingProvider:
+    name = None
+
+    def geocode(self, address):
+        # Returns (lat, lon), or None when the provider has no match for the address.
+        raise NotImplementedError
+
+
+class GoogleGeocodingProvider(GeocodingProvider):
+    name = 'google'
+    url = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+    def __init__(self, api_key, timeout=(3.05, 10), pool_size=10):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # requests is only imported once the first address is actually geocoded.
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                    self._session = session
+        return self._session
+
+    def geocode(self, address):
+        session = self.session
+        import requests
+
+        try:
+            response = session.get(self.url, params={'address': address, 'key': self.api_key},
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise GeocodingError(str(e))
+        if data.get('status') == 'ZERO_RESULTS':
+            return None
+        if data.get('status') != 'OK':
+            raise GeocodingError(data.get('error_message', data.get('status')))
+        location = data['results'][0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+class FakeGeocodingProvider(GeocodingProvider):
+    # Offline provider: known addresses resolve from a fixed table, everything else to a
+    # stable point derived from the address text.
+    name = 'fake'
+
+    def __init__(self, known=None):
+        self.known = {normalize_address(address): coordinates for address, coordinates in (known or {}).items()}
+        self.calls = 0
+
+    def geocode(self, address):
+        self.calls += 1
+        address = normalize_address(address)
+        if address in self.known:
+            return self.known[address]
+        digest = hashlib.sha1(address.encode('utf-8')).digest()
+        lat = int.from_bytes(digest[:4], 'big') / 2 ** 32 * 170 - 85
+        lon = int.from_bytes(digest[4:8], 'big') / 2 ** 32 * 360 - 180
+        return round(lat, 6), round(lon, 6)
+
+
+class Geocoder:
+    # Geocodes addresses through a GeocodedAddress cache keyed by the normalized address.
+    # Addresses that miss the cache are resolved by a background worker after the request commits.
+    # Failed lookups are queued again with a not-before time, ordered behind the work that is due.
+
+    def __init__(self, app=None):
+        self.provider = None
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GEOCODING_PROVIDER', 'google')
+        app.config.setdefault('GEOCODING_TIMEOUT', 10)
+        app.config.setdefault('GEOCODING_ASYNC', True)
+        app.config.setdefault('GEOCODING_MAX_ATTEMPTS', 3)
+        app.config.setdefault('GEOCODING_NEGATIVE_TTL', 86400)
+        if self.provider is None:
+            if app.config['GEOCODING_PROVIDER'] == 'fake':
+                self.provider = FakeGeocodingProvider()
+            else:
+                self.provider = GoogleGeocodingProvider(app.config.get('GOOGLE_MAPS_API_KEY'),
+                                                        timeout=(3.05, app.config['GEOCODING_TIMEOUT']))
+
+    def cached(self, address):
+        # Returns (found, coordinates); coordinates is None for a remembered miss.
+        entry = GeocodedAddress.query.filter_by(address=normalize_address(address)).first()
+        if entry is None:
+            return False, None
+        if entry.lat is None:
+            negative_ttl = timedelta(seconds=current_app.config['GEOCODING_NEGATIVE_TTL'])
+            if entry.updated < datetime.utcnow() - negative_ttl:
+                return False, None
+            return True, None
+        return True, (entry.lat, entry.lon)
+
+    def store(self, address, coordinates):
+        key = normalize_address(address)
+        entry = GeocodedAddress.query.filter_by(address=key).first() or GeocodedAddress(address=key)
+        entry.lat, entry.lon = coordinates if coordinates else (None, None)
+        entry.provider = self.provider.name
+        entry.updated = datetime.utcnow()
+        # Flushed in a savepoint, so losing the race to cache the same address only discards this
+        # entry and not the caller's other changes.
+        try:
+            with db.session.begin_nested():
+                db.session.add(entry)
+        except IntegrityError:
+            # Another worker cached the same address first; keep its entry.
+            pass
+
+    def lookup(self, address):
+        found, coordinates = self.cached(address)
+        if found:
+            return coordinates
+        coordinates = self.provider.geocode(address)
+        self.store(address, coordinates)
+        return coordinates
+
+    def geocode_company_address(self, address_id):
+        company_address = CompanyAddress.query.get(address_id)
+        if company_address is None:
+            return
+        address = address_string(company_address, reference_data.country_names.get(company_address.company_country))
+        coordinates = self.lookup(address)
+        if coordinates:
+            company_address.company_coordinates_lat, company_address.company_coordinates_lon = coordinates
+        db.session.commit()
+
+    def enqueue(self, address_id):
+        if not current_app.config['GEOCODING_ASYNC']:
+            self.geocode_company_address(address_id)
+            return
+        self._put(current_app._get_current_object(), address_id, 1)
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='geocoder', daemon=True)
+                self._worker.start()
+
+    def _put(self, app, address_id, attempt, delay=0):
+        self._queue.put((time.monotonic() + delay, next(self._order), app, address_id, attempt))
+        self._wakeup.set()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            not_before, _, app, address_id, attempt = item
+            wait = not_before - time.monotonic()
+            if wait > 0:
+                # The earliest job is a retry that isn't due yet: put it back and sleep until it
+                # is, or until new work arrives ahead of it.
+                self._wakeup.clear()
+                self._queue.put(item)
+                self._queue.task_done()
+                self._wakeup.wait(wait)
+                continue
+            with app.app_context():
+                try:
+                    self.geocode_company_address(address_id)
+                except GeocodingError as e:
+                    db.session.rollback()
+                    app.logger.warning('Geocoding address %s failed (attempt %s): %s', address_id, attempt, e)
+                    if attempt < app.config['GEOCODING_MAX_ATTEMPTS']:
+                        self._put(app, address_id, attempt + 1, delay=2 ** attempt)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Geocoding address %s failed', address_id)
+            self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+geocoder = Geocoder()
@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from tribezero.database import primary
+from tribezero.hooks import on_commit
+from tribezero.models import Shop, CompanyAddress
+
+
+ShopMarker = namedtuple('ShopMarker', ['id', 'name', 'lat', 'lon', 'category', 'description'])
+
+
+def marker_query():
+    return Shop.query.join(CompanyAddress, Shop.id == CompanyAddress.shop_id)\
+        .with_entities(Shop.id, Shop.name, CompanyAddress.company_coordinates_lat,
+                       CompanyAddress.company_coordinates_lon, Shop.shop_categories, Shop.description)\
+        .filter(CompanyAddress.company_coordinates_lat.isnot(None),
+                CompanyAddress.company_coordinates_lon.isnot(None))
+
+
+class ShopIndex:
+    # Uniform lat/lon grid over the shops that have coordinates. Each cell holds the ids of the
+    # shops inside it, so a viewport query only touches the cells the viewport overlaps.
+
+    def __init__(self, app=None):
+        self.cell_size = 0.5
+        self.ttl = 300
+        self.description_length = 140
+        self._lock = threading.RLock()
+        self._markers = {}
+        self._cells = {}
+        self._stale = set()
+        self._built_at = None
+        self.version = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cell_size = app.config.setdefault('MAP_INDEX_CELL_DEGREES', 0.5)
+        self.ttl = app.config.setdefault('MAP_INDEX_TTL', 300)
+        app.config.setdefault('MAP_MAX_MARKERS', 500)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def _make_marker(self, row):
+        description = (row[5] or '')[:self.description_length]
+        return ShopMarker(row[0], row[1], row[2], row[3], row[4], description)
+
+    def _insert(self, marker):
+        self._remove(marker.id)
+        self._markers[marker.id] = marker
+        self._cells.setdefault(self._cell(marker.lat, marker.lon), set()).add(marker.id)
+
+    def _remove(self, shop_id):
+        marker = self._markers.pop(shop_id, None)
+        if marker is None:
+            return
+        cell = self._cell(marker.lat, marker.lon)
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(shop_id)
+            if not ids:
+                del self._cells[cell]
+
+    def rebuild(self):
+        with primary():
+            rows = marker_query().all()
+        with self._lock:
+            self._markers = {}
+            self._cells = {}
+            for row in rows:
+                self._insert(self._make_marker(row))
+            self._built_at = time.monotonic()
+            self.version += 1
+
+    def invalidate(self, shop_ids=None):
+        with self._lock:
+            if shop_ids is None:
+                self._built_at = None
+            else:
+                self._stale.update(shop_ids)
+
+    def _refresh(self):
+        with self._lock:
+            expired = self._built_at is None or time.monotonic() - self._built_at > self.ttl
+            stale, self._stale = self._stale, set()
+        if expired:
+            self.rebuild()
+            return
+        if not stale:
+            return
+        with primary():
+            rows = marker_query().filter(Shop.id.in_(stale)).all()
+        with self._lock:
+            for shop_id in stale:
+                self._remove(shop_id)
+            for row in rows:
+                self._insert(self._make_marker(row))
+            self.version += 1
+
+    def snapshot(self):
+        self._refresh()
+        with self._lock:
+            return list(self._markers.values()), self.version
+
+    def get(self, shop_id):
+        self._refresh()
+        with self._lock:
+            return self._markers.get(shop_id)
+
+    def _cells_in(self, south, west, north, east):
+        lat_min, lon_min = self._cell(south, west)
+        lat_max, lon_max = self._cell(north, east)
+        span = (lat_max - lat_min + 1) * (lon_max - lon_min + 1)
+        if span > len(self._cells):
+            return [ids for (i, j), ids in self._cells.items()
+                    if lat_min <= i <= lat_max and lon_min <= j <= lon_max]
+        found = []
+        for i in range(lat_min, lat_max + 1):
+            for j in range(lon_min, lon_max + 1):
+                ids = self._cells.get((i, j))
+                if ids:
+                    found.append(ids)
+        return found
+
+    def query_bbox(self, south, west, north, east, limit=None):
+        self._refresh()
+        # A viewport crossing the antimeridian arrives with west > east; split it in two.
+        if west > east:
+            boxes = [(south, west, north, 180.0), (south, -180.0, north, east)]
+        else:
+            boxes = [(south, west, north, east)]
+        results = []
+        with self._lock:
+            for s, w, n, e in boxes:
+                for ids in self._cells_in(s, w, n, e):
+                    for shop_id in ids:
+                        marker = self._markers[shop_id]
+                        if s <= marker.lat <= n and w <= marker.lon <= e:
+                            results.append(marker)
+                            if limit is not None and len(results) > limit:
+                                return results[:limit], True
+        return results, False
+
+
+shop_index = ShopIndex()
+
+
+@on_commit(Shop)
+def _shops_changed(shop_ids):
+    shop_index.invalidate(shop_ids)
+
+
+@on_commit(CompanyAddress, key=lambda address: address.shop_id)
+def _addresses_changed(shop_ids):
+    shop_index.invalidate(shop_ids)
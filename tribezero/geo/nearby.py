@@ -0,0 +1,67 @@
+import math
+import threading
+from tribezero.geo.index import shop_index
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class NearbyShops:
+    # Columnar copy of the shop index sorted by latitude. A query narrows the candidates with a
+    # binary search on latitude plus a longitude mask, then ranks them with a vectorized haversine.
+    # numpy is imported on the first query rather than with the app.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._columns = None
+
+    def _arrays(self):
+        import numpy as np
+
+        markers, version = shop_index.snapshot()
+        with self._lock:
+            if version != self._version:
+                markers.sort(key=lambda marker: marker.lat)
+                self._columns = (np.fromiter((m.id for m in markers), dtype=np.int64, count=len(markers)),
+                                 np.fromiter((m.lat for m in markers), dtype=np.float64, count=len(markers)),
+                                 np.fromiter((m.lon for m in markers), dtype=np.float64, count=len(markers)),
+                                 np.array([m.category for m in markers], dtype=object))
+                self._version = version
+            return self._columns
+
+    def query(self, lat, lon, radius_km, category=None, limit=20):
+        import numpy as np
+
+        ids, lats, lons, categories = self._arrays()
+
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        start = np.searchsorted(lats, lat - dlat, side='left')
+        end = np.searchsorted(lats, lat + dlat, side='right')
+        lats, lons, ids, categories = lats[start:end], lons[start:end], ids[start:end], categories[start:end]
+
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        if cos_lat > 1e-6:
+            dlon = min(dlat / cos_lat, 180.0)
+            mask = np.abs((lons - lon + 180.0) % 360.0 - 180.0) <= dlon
+        else:
+            mask = np.ones(len(ids), dtype=bool)
+        if category is not None:
+            mask &= categories == category
+        lats, lons, ids = lats[mask], lons[mask], ids[mask]
+
+        phi1, phi2 = math.radians(lat), np.radians(lats)
+        a = np.sin((phi2 - phi1) / 2) ** 2 + \
+            math.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lons - lon) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        within = distances <= radius_km
+        ids, distances = ids[within], distances[within]
+        if len(ids) > limit:
+            top = np.argpartition(distances, limit)[:limit]
+            ids, distances = ids[top], distances[top]
+        order = np.argsort(distances)
+        return [(int(ids[i]), float(distances[i])) for i in order]
+
+
+nearby_shops = NearbyShops()
@@ -0,0 +1,47 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+_listeners = []
+
+
+def on_commit(*models, key=lambda obj: obj.id):
+    # Registers f(keys) to be called once a transaction touching any of `models` has committed.
+    # Keys are collected at flush time, so the callback never has to load expired instances.
+    def decorator(f):
+        _listeners.append((models, key, f))
+        return f
+    return decorator
+
+
+def mark_changed(session, model, keys):
+    # For writes that bypass the unit of work (bulk inserts, Query.update): runs the on_commit
+    # listeners of `model` for `keys` when the session commits, as if they had been flushed.
+    pending = session.info.setdefault('tribezero_pending', {})
+    for index, (models, _, _) in enumerate(_listeners):
+        if issubclass(model, models):
+            pending.setdefault(index, set()).update(keys)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault('tribezero_pending', {})
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    for index, (models, key, _) in enumerate(_listeners):
+        for obj in changed:
+            if isinstance(obj, models):
+                pending.setdefault(index, set()).add(key(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def _fire_listeners(session):
+    pending = session.info.pop('tribezero_pending', {})
+    for index, keys in pending.items():
+        keys.discard(None)
+        if keys:
+            _listeners[index][2](keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('tribezero_pending', None)
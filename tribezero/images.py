@@ -0,0 +1,204 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+from tribezero.models import User, Shop, Listing
+
+
+images_cli = AppGroup('images', help='Uploaded image maintenance.')
+
+# Each kind of upload is stored under one static folder. The 'md' variant keeps the bare
+# content-hash name, so templates that reference the stored name keep working unchanged.
+KINDS = {
+    'profile': {'folder': 'profile_pics', 'sizes': {'sm': (48, 48), 'md': (125, 125), 'lg': (400, 400)}},
+    'shop': {'folder': 'shop_pics', 'sizes': {'sm': (64, 64), 'md': (250, 250), 'lg': (600, 600)}},
+    'cover': {'folder': 'shop_pics', 'sizes': {'sm': (600, 150), 'md': (1200, 300), 'lg': (2400, 600)}},
+    'listing': {'folder': 'listing_pics', 'sizes': {'sm': (150, 150), 'md': (400, 400), 'lg': (1200, 1200)}},
+}
+DEFAULT_IMAGES = {'default.jpg', 'default_shop.jpg', 'default_cover.jpg', 'default_listing.jpg'}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def variant_name(name, size, extension=None):
+    stem, ext = os.path.splitext(name)
+    suffix = '' if size == 'md' else f'_{size}'
+    return f'{stem}{suffix}{extension or ext}'
+
+
+def base_name(filename):
+    stem, _ = os.path.splitext(filename)
+    for size in ('_sm', '_lg'):
+        if stem.endswith(size):
+            stem = stem[:-len(size)]
+    return stem
+
+
+class ImagePipeline:
+    # Uploads are hashed in the request and written once per distinct content; resizing and
+    # WebP encoding happen on a small thread pool. Until the variants exist the original bytes
+    # are served under the final name.
+
+    def __init__(self, app=None):
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_ASYNC', True)
+        app.config.setdefault('IMAGE_WORKERS', 2)
+        app.config.setdefault('IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('IMAGE_GC_GRACE_SECONDS', 3600)
+        app.jinja_env.globals['image_url'] = image_url
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'],
+                                                thread_name_prefix='images')
+            return self._pool
+
+    def folder(self, kind):
+        path = os.path.join(current_app.root_path, 'static', KINDS[kind]['folder'])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def store(self, upload, kind):
+        data = upload.read(current_app.config['IMAGE_MAX_BYTES'] + 1)
+        if len(data) > current_app.config['IMAGE_MAX_BYTES']:
+            raise InvalidImage('Image is too large.')
+        from PIL import Image
+
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                has_alpha = image.mode in ('RGBA', 'LA', 'P') and 'transparency' in image.info \
+                    or image.mode in ('RGBA', 'LA')
+        except (IOError, SyntaxError):
+            raise InvalidImage('Unsupported image format.')
+
+        name = hashlib.sha256(data).hexdigest()[:16] + ('.png' if has_alpha else '.jpg')
+        folder = self.folder(kind)
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return name
+
+        sizes = KINDS[kind]['sizes']
+        write_atomic(path, data)
+        if current_app.config['IMAGE_ASYNC']:
+            future = self._executor().submit(process_image, data, folder, name, sizes)
+            future.add_done_callback(partial(self._processed, current_app._get_current_object(), folder, name, sizes))
+            return name
+        try:
+            process_image(data, folder, name, sizes)
+        except Exception:
+            current_app.logger.exception('Processing image %s failed', name)
+            discard_image(folder, name, sizes)
+            raise InvalidImage('Image could not be processed.')
+        return name
+
+    def _processed(self, app, folder, name, sizes, future):
+        # A failed upload is removed rather than left serving its unprocessed bytes under the
+        # final name; removing it also lets a later upload of the same content try again.
+        error = future.exception()
+        if error is not None:
+            app.logger.error('Processing image %s failed', name, exc_info=error)
+            discard_image(folder, name, sizes)
+
+
+def write_atomic(path, data):
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def discard_image(folder, name, sizes):
+    for size in sizes:
+        for extension in (None, '.webp'):
+            try:
+                os.remove(os.path.join(folder, variant_name(name, size, extension)))
+            except FileNotFoundError:
+                pass
+
+
+def save_variant(image, path, format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    write_atomic(path, buffer.getvalue())
+
+
+def process_image(data, folder, name, sizes):
+    from PIL import Image, ImageOps, features
+
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        keep_alpha = name.endswith('.png')
+        image = image.convert('RGBA' if keep_alpha else 'RGB')
+        webp = features.check('webp')
+        # Largest first, so the bare name (the md variant) is replaced last.
+        for size, dimensions in sorted(sizes.items(), key=lambda item: -item[1][0] * item[1][1]):
+            variant = image.copy()
+            variant.thumbnail(dimensions, Image.LANCZOS)
+            if webp:
+                save_variant(variant, os.path.join(folder, variant_name(name, size, '.webp')), 'WEBP', quality=80)
+            if keep_alpha:
+                save_variant(variant, os.path.join(folder, variant_name(name, size)), 'PNG', optimize=True)
+            else:
+                save_variant(variant, os.path.join(folder, variant_name(name, size)), 'JPEG',
+                             quality=85, optimize=True, progressive=True)
+
+
+def image_url(kind, name, size='md'):
+    folder = KINDS[kind]['folder']
+    if size != 'md' and name not in DEFAULT_IMAGES:
+        variant = variant_name(name, size)
+        if os.path.isfile(os.path.join(current_app.root_path, 'static', folder, variant)):
+            return url_for('static', filename=f'{folder}/{variant}')
+    return url_for('static', filename=f'{folder}/{name}')
+
+
+images = ImagePipeline()
+
+
+def referenced_images():
+    names = set(DEFAULT_IMAGES)
+    names.update(name for (name,) in User.query.with_entities(User.image_file))
+    for image_file, cover_image in Shop.query.with_entities(Shop.image_file, Shop.cover_image):
+        names.update((image_file, cover_image))
+    for (listing_images,) in Listing.query.with_entities(Listing.images).yield_per(1000):
+        if isinstance(listing_images, dict):
+            names.update(listing_images.values())
+        elif isinstance(listing_images, list):
+            names.update(listing_images)
+    return {base_name(name) for name in names if name}
+
+
+@images_cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be removed.')
+def gc(dry_run):
+    """Delete uploaded images that no user, shop or listing refers to."""
+    referenced = referenced_images()
+    cutoff = time.time() - current_app.config['IMAGE_GC_GRACE_SECONDS']
+    removed = 0
+    for folder in sorted({kind['folder'] for kind in KINDS.values()}):
+        path = os.path.join(current_app.root_path, 'static', folder)
+        if not os.path.isdir(path):
+            continue
+        for filename in sorted(os.listdir(path)):
+            file_path = os.path.join(path, filename)
+            if base_name(filename) in referenced or os.path.getmtime(file_path) > cutoff:
+                continue
+            removed += 1
+            click.echo(f'{"Would remove" if dry_run else "Removing"} {folder}/{filename}')
+            if not dry_run:
+                os.remove(file_path)
+    click.echo(f'{removed} orphaned files.')
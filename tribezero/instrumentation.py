@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from tribezero.metrics import Histogram, render_histogram, render_metric
+
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.statements = defaultdict(lambda: [0, 0.0])
+        self._templates = []
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats.queries += 1
+    stats.sql_time += elapsed
+    entry = stats.statements[statement]
+    entry[0] += 1
+    entry[1] += elapsed
+
+
+class Instrumentation:
+    # Times every request along with the SQL statements and templates it ran, aggregates the
+    # numbers per endpoint, and logs requests over SLOW_REQUEST_SECONDS or SLOW_REQUEST_QUERIES
+    # together with their most expensive statements (repeated statements point at N+1 loads).
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.queries = {}
+        self.sql_time = {}
+        self.template_time = {}
+        self.requests = defaultdict(int)
+        self.slow_requests = defaultdict(int)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        app.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)
+        app.config.setdefault('SLOW_REQUEST_QUERIES', 25)
+        app.config.setdefault('SLOW_REQUEST_STATEMENTS', 5)
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+    def _start(self):
+        g._request_stats = RequestStats()
+
+    def _template_started(self, app, template, context, **extra):
+        stats = current_stats()
+        if stats is not None:
+            stats._templates.append(time.perf_counter())
+
+    def _template_finished(self, app, template, context, **extra):
+        stats = current_stats()
+        if stats is not None and stats._templates:
+            started = stats._templates.pop()
+            if not stats._templates:
+                stats.template_time += time.perf_counter() - started
+
+    def _histogram(self, histograms, endpoint, buckets=None):
+        histogram = histograms.get(endpoint)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(endpoint, Histogram(buckets) if buckets else Histogram())
+        return histogram
+
+    def _finish(self, response):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return response
+        latency = time.perf_counter() - stats.started
+        endpoint = request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+        self._histogram(self.latency, endpoint).observe(latency)
+        self._histogram(self.queries, endpoint, QUERY_BUCKETS).observe(stats.queries)
+        self._histogram(self.sql_time, endpoint).observe(stats.sql_time)
+        if stats.template_time:
+            self._histogram(self.template_time, endpoint).observe(stats.template_time)
+
+        config = current_app.config
+        slow = latency >= config['SLOW_REQUEST_SECONDS'] or stats.queries >= config['SLOW_REQUEST_QUERIES']
+        with self._lock:
+            self.requests[(endpoint, request.method, response.status_code)] += 1
+            if slow:
+                self.slow_requests[endpoint] += 1
+        if slow:
+            worst = sorted(stats.statements.items(), key=lambda item: item[1][1], reverse=True)
+            lines = [f'  {count}x {total * 1000:.1f} ms  {" ".join(statement.split())[:300]}'
+                     for statement, (count, total) in worst[:config['SLOW_REQUEST_STATEMENTS']]]
+            current_app.logger.warning(
+                'Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, templates %.0f ms\n%s',
+                request.method, request.path, endpoint, latency * 1000, stats.queries,
+                stats.sql_time * 1000, stats.template_time * 1000, '\n'.join(lines))
+        return response
+
+    def render(self):
+        with self._lock:
+            requests = sorted(self.requests.items())
+            slow_requests = sorted(self.slow_requests.items())
+            families = {'latency': dict(self.latency), 'queries': dict(self.queries),
+                        'sql': dict(self.sql_time), 'templates': dict(self.template_time)}
+        snapshots = {name: [({'endpoint': endpoint}, histogram.snapshot())
+                            for endpoint, histogram in sorted(histograms.items())]
+                     for name, histograms in families.items()}
+        lines = render_metric('tribezero_http_requests_total', 'counter', 'Requests served.',
+                              [({'endpoint': endpoint, 'method': method, 'status': status}, count)
+                               for (endpoint, method, status), count in requests])
+        lines += render_metric('tribezero_http_slow_requests_total', 'counter',
+                               'Requests over the latency or query-count threshold.',
+                               [({'endpoint': endpoint}, count) for endpoint, count in slow_requests])
+        lines += render_histogram('tribezero_http_request_duration_seconds', 'Request latency.',
+                                  snapshots['latency'])
+        lines += render_histogram('tribezero_http_request_queries', 'SQL statements per request.',
+                                  snapshots['queries'])
+        lines += render_histogram('tribezero_http_request_sql_seconds', 'Time spent in SQL per request.',
+                                  snapshots['sql'])
+        lines += render_histogram('tribezero_http_request_template_seconds', 'Template render time per request.',
+                                  snapshots['templates'])
+        return lines
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,267 @@
+import random
+import threading
+from collections import defaultdict
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, event, func
+from sqlalchemy.exc import IntegrityError
+from tribezero import db
+from tribezero.hooks import mark_changed
+from tribezero.models import LedgerEntry, ShopBalance, UserBalance, Shop, Financial, TransactionHistory
+
+
+ledger_cli = AppGroup('ledger', help='Sales ledger and balances.')
+
+# Effect of one entry of each kind on the owner's balance, as (column, per entry, per unit of
+# amount). Reconciliation applies the same table to counts and sums of entries.
+SHOP_EFFECTS = {
+    'purchase': (('orders', 1, 0), ('sales', 0, 1), ('revenue', 0, 1), ('amount_due', 0, 1)),
+    'cancellation': (('cancellations', 1, 0), ('cancelled_sales', 0, 1), ('revenue', 0, -1), ('amount_due', 0, -1)),
+    'payout': (('payouts', 1, 0), ('paid_out', 0, 1), ('amount_due', 0, -1)),
+}
+USER_EFFECTS = {
+    'purchase': (('orders', 1, 0), ('purchases', 0, 1)),
+    'cancellation': (('cancellations', 1, 0), ('refunded', 0, 1)),
+}
+KINDS = tuple(SHOP_EFFECTS)
+
+
+class LedgerError(ValueError):
+    pass
+
+
+def deltas(effects, count, total):
+    values = defaultdict(int)
+    for column, per_entry, per_amount in effects:
+        values[column] += per_entry * count + per_amount * total
+    return values
+
+
+def balance_columns(model):
+    return [column.name for column in model.__table__.columns if not column.primary_key]
+
+
+def insert_missing(table, values):
+    # INSERT that does nothing when the primary key already exists, in the caller's transaction.
+    dialect = db.session.connection().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return db.session.execute(insert(table).values(values).on_conflict_do_nothing())
+    prefix = 'IGNORE' if dialect == 'mysql' else 'OR IGNORE'
+    return db.session.execute(table.insert().values(values).prefix_with(prefix))
+
+
+class Ledger:
+    # Purchases, cancellations and payouts are appended to ledger_entry and never changed. Each
+    # entry adds its deltas to the shop's and buyer's materialized balances in the same
+    # transaction with `SET col = col + n`, so recording an order is one insert and at most two
+    # single-row updates, and concurrent orders never overwrite each other. A balance is spread
+    # over LEDGER_BALANCE_SLOTS rows picked at random, so orders for one busy shop don't queue on
+    # a single row lock; reading a balance sums its slots. A periodic reconciliation recomputes
+    # balances from the entries, repairs drift and mirrors the totals into the older Shop,
+    # Financial and TransactionHistory counter columns.
+
+    def __init__(self, app=None):
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LEDGER_BALANCE_SLOTS', 8)
+        app.config.setdefault('LEDGER_RECONCILE_INTERVAL', 3600)
+        app.config.setdefault('LEDGER_RECONCILE_BATCH', 200)
+
+    def record(self, kind, amount, shop_id, user_id=None, reference=None, key=None, reverses=None):
+        if kind not in SHOP_EFFECTS:
+            raise LedgerError(f'Unknown ledger entry kind {kind!r}')
+        if not isinstance(amount, int) or amount <= 0:
+            raise LedgerError('Ledger amounts are positive integers in the smallest currency unit.')
+        if key is not None:
+            existing = LedgerEntry.query.filter_by(idempotency_key=key).first()
+            if existing is not None:
+                return existing
+        entry = LedgerEntry(kind=kind, amount=amount, shop_id=shop_id, user_id=user_id, reference=reference,
+                            idempotency_key=key, reverses_id=reverses.id if reverses is not None else None)
+        # A concurrent retry with the same key can get past the check above; the savepoint lets
+        # the loser drop its entry and balance deltas and return the winner's entry instead.
+        try:
+            with db.session.begin_nested():
+                db.session.add(entry)
+                self._apply(ShopBalance, ShopBalance.shop_id, shop_id, deltas(SHOP_EFFECTS[kind], 1, amount))
+                if user_id is not None and kind in USER_EFFECTS:
+                    self._apply(UserBalance, UserBalance.user_id, user_id, deltas(USER_EFFECTS[kind], 1, amount))
+        except IntegrityError:
+            existing = LedgerEntry.query.filter_by(idempotency_key=key).first() if key is not None else None
+            if existing is None:
+                raise
+            return existing
+        self._ensure_worker(current_app._get_current_object())
+        return entry
+
+    def purchase(self, shop_id, amount, user_id=None, reference=None, key=None):
+        return self.record('purchase', amount, shop_id, user_id=user_id, reference=reference, key=key)
+
+    def cancel(self, purchase):
+        # One cancellation per purchase: the idempotency key makes a second one a no-op.
+        if purchase.kind != 'purchase':
+            raise LedgerError('Only purchases can be cancelled.')
+        return self.record('cancellation', purchase.amount, purchase.shop_id, user_id=purchase.user_id,
+                           reference=purchase.reference, key=f'cancellation:{purchase.id}', reverses=purchase)
+
+    def payout(self, shop_id, amount, reference=None, key=None):
+        return self.record('payout', amount, shop_id, reference=reference, key=key)
+
+    def _apply(self, model, owner_column, owner_id, values):
+        table = model.__table__
+        slot = random.randrange(current_app.config['LEDGER_BALANCE_SLOTS'])
+        update = table.update().where(and_(table.c[owner_column.key] == owner_id, table.c.slot == slot))\
+            .values({column: table.c[column] + delta for column, delta in values.items() if delta})
+        if db.session.execute(update).rowcount:
+            return
+        insert_missing(table, {owner_column.key: owner_id, 'slot': slot})
+        db.session.execute(update)
+
+    def _balance(self, model, owner_column, owner_id):
+        columns = balance_columns(model)
+        row = db.session.query(*[func.coalesce(func.sum(getattr(model, column)), 0) for column in columns])\
+            .filter(owner_column == owner_id).one()
+        return dict(zip(columns, map(int, row)))
+
+    def shop_balance(self, shop_id):
+        return self._balance(ShopBalance, ShopBalance.shop_id, shop_id)
+
+    def user_balance(self, user_id):
+        return self._balance(UserBalance, UserBalance.user_id, user_id)
+
+    def _owners(self, model, owner_column, entry_column, after, limit):
+        owners = {owner for (owner,) in db.session.query(entry_column.distinct())
+                  .filter(entry_column > after).order_by(entry_column).limit(limit)}
+        owners.update(owner for (owner,) in db.session.query(owner_column.distinct())
+                      .filter(owner_column > after).order_by(owner_column).limit(limit))
+        return sorted(owners)[:limit]
+
+    def _reconcile_batch(self, model, owner_column, entry_column, effects, owners, fix):
+        table = model.__table__
+        columns = balance_columns(model)
+        # A no-op update locks the batch's balance rows (the whole database on SQLite) until
+        # commit, so no order can land between summing the entries and repairing the balances.
+        db.session.execute(table.update().where(table.c[owner_column.key].in_(owners))
+                           .values({columns[0]: table.c[columns[0]]}))
+        expected = {owner: dict.fromkeys(columns, 0) for owner in owners}
+        for owner, kind, count, total in db.session.query(entry_column, LedgerEntry.kind, func.count(),
+                                                          func.coalesce(func.sum(LedgerEntry.amount), 0))\
+                .filter(entry_column.in_(owners)).group_by(entry_column, LedgerEntry.kind):
+            for column, delta in deltas(effects.get(kind, ()), count, int(total)).items():
+                expected[owner][column] += delta
+        actual = {row[0]: dict(zip(columns, map(int, row[1:]))) for row in
+                  db.session.query(owner_column, *[func.sum(getattr(model, column)) for column in columns])
+                  .filter(owner_column.in_(owners)).group_by(owner_column)}
+
+        mismatches = []
+        for owner in owners:
+            have = actual.get(owner, dict.fromkeys(columns, 0))
+            if have == expected[owner]:
+                continue
+            mismatches.append((table.name, owner, {column: (have[column], expected[owner][column])
+                                                   for column in columns if have[column] != expected[owner][column]}))
+            if fix:
+                db.session.execute(table.delete().where(table.c[owner_column.key] == owner))
+                db.session.execute(table.insert().values(dict(expected[owner], slot=0, **{owner_column.key: owner})))
+        return mismatches, expected
+
+    def _mirror_shops(self, balances):
+        changed = set()
+        for shop_id, total_orders, total_sales, cancelled_sales in db.session.query(
+                Shop.id, Shop.total_orders, Shop.total_sales, Shop.cancelled_sales).filter(Shop.id.in_(balances)):
+            balance = balances[shop_id]
+            if (total_orders, total_sales, cancelled_sales) != \
+                    (balance['orders'], balance['sales'], balance['cancelled_sales']):
+                Shop.query.filter(Shop.id == shop_id).update(
+                    {Shop.total_orders: balance['orders'], Shop.total_sales: balance['sales'],
+                     Shop.cancelled_sales: balance['cancelled_sales']}, synchronize_session=False)
+                changed.add(shop_id)
+        for shop_id, revenue, amount_due in db.session.query(Financial.shop_id, Financial.revenue, Financial.amount_due)\
+                .filter(Financial.shop_id.in_(balances)):
+            balance = balances[shop_id]
+            if (revenue, amount_due) != (balance['revenue'], balance['amount_due']):
+                Financial.query.filter(Financial.shop_id == shop_id).update(
+                    {Financial.revenue: balance['revenue'], Financial.amount_due: balance['amount_due']},
+                    synchronize_session=False)
+        if changed:
+            mark_changed(db.session, Shop, changed)
+
+    def _mirror_users(self, balances):
+        for user_id, purchases, orders in db.session.query(
+                TransactionHistory.user_id, TransactionHistory.purchases, TransactionHistory.orders)\
+                .filter(TransactionHistory.user_id.in_(balances)):
+            balance = balances[user_id]
+            if (purchases, orders) != (balance['purchases'], balance['orders']):
+                TransactionHistory.query.filter(TransactionHistory.user_id == user_id).update(
+                    {TransactionHistory.purchases: balance['purchases'], TransactionHistory.orders: balance['orders']},
+                    synchronize_session=False)
+
+    def reconcile(self, fix=True):
+        batch = current_app.config['LEDGER_RECONCILE_BATCH']
+        mismatches = []
+        for model, owner_column, entry_column, effects, mirror in (
+                (ShopBalance, ShopBalance.shop_id, LedgerEntry.shop_id, SHOP_EFFECTS, self._mirror_shops),
+                (UserBalance, UserBalance.user_id, LedgerEntry.user_id, USER_EFFECTS, self._mirror_users)):
+            after = 0
+            while True:
+                owners = self._owners(model, owner_column, entry_column, after, batch)
+                if not owners:
+                    break
+                found, expected = self._reconcile_batch(model, owner_column, entry_column, effects, owners, fix)
+                mismatches += found
+                if fix:
+                    mirror(expected)
+                    db.session.commit()
+                else:
+                    db.session.rollback()
+                after = owners[-1]
+        for table, owner, columns in mismatches:
+            current_app.logger.warning('Ledger balance %s %s drifted: %s', table, owner, columns)
+        return mismatches
+
+    def _ensure_worker(self, app):
+        if not app.config['LEDGER_RECONCILE_INTERVAL']:
+            # Reconciliation is left to 'flask ledger reconcile', e.g. from cron.
+            return
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, args=(app,), name='ledger', daemon=True)
+                self._worker.start()
+
+    def _work(self, app):
+        while True:
+            threading.Event().wait(app.config['LEDGER_RECONCILE_INTERVAL'])
+            with app.app_context():
+                try:
+                    self.reconcile()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Ledger reconciliation failed')
+
+
+ledger = Ledger()
+
+
+@event.listens_for(LedgerEntry, 'before_update')
+@event.listens_for(LedgerEntry, 'before_delete')
+def _append_only(mapper, connection, target):
+    raise LedgerError('Ledger entries are never changed; record a cancellation instead.')
+
+
+@ledger_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help='Only report balances that differ from the ledger.')
+def reconcile(dry_run):
+    """Recompute shop and user balances from the ledger and repair any drift."""
+    mismatches = ledger.reconcile(fix=not dry_run)
+    for table, owner, columns in mismatches:
+        changes = ', '.join(f'{column} {have} -> {want}' for column, (have, want) in columns.items())
+        click.echo(f'{table} {owner}: {changes}')
+    click.echo(f'{len(mismatches)} balances {"differ" if dry_run else "repaired"}.')
@@ -0,0 +1,310 @@
+import csv
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from tribezero import db
+from tribezero.hooks import mark_changed, on_commit
+from tribezero.images import images, InvalidImage
+from tribezero.listings.utils import normalize_tags, tags_by_name
+from tribezero.models import Listing, ListingImport, Shop, Tag, listing_tag
+from tribezero.search.utils import index_documents
+
+
+listings_cli = AppGroup('listings', help='Listing catalogue maintenance.')
+
+MAX_IMAGES = 10
+DEFAULT_IMAGES = {'image1': 'default_listing.jpg'}
+ImportedListing = namedtuple('ImportedListing', ['id', 'name', 'tags'])
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+class ImportReport:
+
+    def __init__(self, max_errors=1000):
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append([line, message])
+
+
+class ImageResolver:
+    # Image columns name files in `folder`; each distinct file is stored once per import.
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._stored = {}
+
+    def resolve(self, ref):
+        if ref not in self._stored:
+            path = safe_join(self.folder, ref) if self.folder else None
+            if path is None or not os.path.isfile(path):
+                raise InvalidRow(f'Image {ref!r} was not found.')
+            try:
+                with open(path, 'rb') as f:
+                    self._stored[ref] = images.store(f, 'listing')
+            except InvalidImage as e:
+                self._stored[ref] = e
+        stored = self._stored[ref]
+        if isinstance(stored, InvalidImage):
+            raise InvalidRow(f'Image {ref!r}: {stored}')
+        return stored
+
+
+def validate_row(record, resolver):
+    name = ' '.join((record.get('name') or '').split())
+    if not name:
+        raise InvalidRow('Name is required.')
+    if len(name) > 30:
+        raise InvalidRow('Name must be at most 30 characters.')
+    refs = [ref.strip() for ref in (record.get('images') or '').split('|') if ref.strip()]
+    if len(refs) > MAX_IMAGES:
+        raise InvalidRow(f'At most {MAX_IMAGES} images are allowed.')
+    stored = [resolver.resolve(ref) for ref in refs]
+    return {'name': name,
+            'tags': normalize_tags(record.get('tags') or ''),
+            'images': {f'image{index}': image for index, image in enumerate(stored, 1)} if stored else DEFAULT_IMAGES}
+
+
+def insert_batch(shop_id, rows):
+    # bulk_insert_mappings skips the unit of work, so what the before_flush and mapper hooks do
+    # for a single Listing is done here for the whole batch: tag links and counts, the search
+    # index and the on_commit listeners.
+    session = db.session
+    # Bumping the shop's counter first takes its row lock (the database write lock on SQLite), so
+    # no other import into this shop can interleave its ids with this batch.
+    Shop.query.filter(Shop.id == shop_id)\
+        .update({Shop.active_listings: func.coalesce(Shop.active_listings, 0) + len(rows)}, synchronize_session=False)
+    last_id = session.query(func.max(Listing.id)).filter(Listing.shop_id == shop_id).scalar() or 0
+    session.bulk_insert_mappings(Listing, [dict(row, shop_id=shop_id) for row in rows])
+    ids = [listing_id for (listing_id,) in session.query(Listing.id)
+           .filter(Listing.shop_id == shop_id, Listing.id > last_id).order_by(Listing.id)]
+
+    tags = tags_by_name(session, {name for row in rows for name in row['tags']})
+    session.flush()
+    links = [{'listing_id': listing_id, 'tag_id': tags[name].id}
+             for listing_id, row in zip(ids, rows) for name in row['tags']]
+    if links:
+        session.execute(listing_tag.insert(), links)
+        counts = Counter(link['tag_id'] for link in links)
+        session.execute(Tag.__table__.update().where(Tag.id == bindparam('tag'))
+                        .values(listing_count=Tag.listing_count + bindparam('delta')),
+                        [{'tag': tag_id, 'delta': delta} for tag_id, delta in counts.items()])
+
+    index_documents(session.connection(), [ImportedListing(listing_id, row['name'], row['tags'])
+                                           for listing_id, row in zip(ids, rows)])
+    mark_changed(session, Listing, ids)
+    mark_changed(session, Shop, {shop_id})
+    return ids
+
+
+class ListingImporter:
+    # Catalogue CSVs (name, tags, images columns) are read a batch at a time: rows are validated
+    # and their images stored, then the valid ones are written with one bulk insert and committed.
+    # A bad row is reported by line number and skipped; it never stops the import. Uploads are
+    # queued as listing_import rows and run on a background thread, like the outbox.
+
+    def __init__(self, app=None):
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LISTING_IMPORT_ASYNC', True)
+        app.config.setdefault('LISTING_IMPORT_DIR', os.path.join(app.instance_path, 'imports'))
+        app.config.setdefault('LISTING_IMPORT_BATCH', 500)
+        app.config.setdefault('LISTING_IMPORT_MAX_ROWS', 50000)
+        app.config.setdefault('LISTING_IMPORT_MAX_ERRORS', 1000)
+        app.config.setdefault('LISTING_IMPORT_LOCK_SECONDS', 3600)
+        app.config.setdefault('LISTING_IMPORT_POLL_INTERVAL', 60)
+
+    def run(self, shop_id, stream, image_folder=None, on_batch=None):
+        config = current_app.config
+        report = ImportReport(config['LISTING_IMPORT_MAX_ERRORS'])
+        reader = csv.DictReader(stream)
+        if reader.fieldnames is None:
+            report.error(1, 'The file is empty.')
+            return report
+        reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames]
+        if 'name' not in reader.fieldnames:
+            report.error(1, 'The header row has no "name" column.')
+            return report
+
+        resolver = ImageResolver(image_folder)
+        max_rows = config['LISTING_IMPORT_MAX_ROWS']
+        records = islice(((reader.line_num, record) for record in reader), max_rows)
+        while True:
+            batch = list(islice(records, config['LISTING_IMPORT_BATCH']))
+            if not batch:
+                break
+            report.rows += len(batch)
+            valid = []
+            for line, record in batch:
+                try:
+                    valid.append((line, validate_row(record, resolver)))
+                except InvalidRow as e:
+                    report.error(line, str(e))
+            if valid:
+                self._write(shop_id, valid, report)
+            if on_batch is not None:
+                on_batch(report)
+            db.session.commit()
+        if next(reader, None) is not None:
+            report.errors.append([reader.line_num, f'Only the first {max_rows} rows are imported; the rest were skipped.'])
+        return report
+
+    def _write(self, shop_id, valid, report):
+        rows = [row for _, row in valid]
+        # Retried once, since a concurrent import can create one of the same new tags first.
+        for attempt in range(2):
+            try:
+                insert_batch(shop_id, rows)
+                db.session.commit()
+                report.imported += len(rows)
+                return
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                if attempt == 0 and isinstance(e, IntegrityError):
+                    continue
+                current_app.logger.exception('Listing import batch for shop %s failed', shop_id)
+                for line, _ in valid:
+                    report.error(line, f'Could not be saved: {e.__class__.__name__}')
+                return
+
+    def enqueue(self, shop, upload, image_uploads=()):
+        folder = os.path.join(current_app.config['LISTING_IMPORT_DIR'], uuid.uuid4().hex)
+        os.makedirs(os.path.join(folder, 'images'))
+        upload.save(os.path.join(folder, 'listings.csv'))
+        for image in image_uploads:
+            filename = secure_filename(image.filename or '')
+            if filename:
+                image.save(os.path.join(folder, 'images', filename))
+        job = ListingImport(path=folder, shop_id=shop.id, status='pending')
+        db.session.add(job)
+        return job
+
+    def _claim(self, now):
+        lock_seconds = current_app.config['LISTING_IMPORT_LOCK_SECONDS']
+        # An import still marked running after its lock expired died with its worker; rerunning
+        # it would duplicate the batches it had already committed.
+        ListingImport.query.filter(ListingImport.status == 'running', ListingImport.locked_until < now)\
+            .update({'status': 'failed', 'finished_at': now, 'locked_until': None}, synchronize_session=False)
+        db.session.commit()
+        for (job_id,) in ListingImport.query.with_entities(ListingImport.id)\
+                .filter(ListingImport.status == 'pending').order_by(ListingImport.created).limit(10):
+            claimed = ListingImport.query.filter(ListingImport.id == job_id, ListingImport.status == 'pending')\
+                .update({'status': 'running', 'started_at': now,
+                         'locked_until': now + timedelta(seconds=lock_seconds)}, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return ListingImport.query.get(job_id)
+        return None
+
+    def process(self, job):
+        def on_batch(report):
+            job.rows, job.imported, job.failed, job.errors = report.rows, report.imported, report.failed, \
+                list(report.errors)
+
+        try:
+            with open(os.path.join(job.path, 'listings.csv'), 'r', encoding='utf-8-sig', newline='') as f:
+                report = self.run(job.shop_id, f, os.path.join(job.path, 'images'), on_batch)
+            on_batch(report)
+            job.status = 'done'
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            db.session.rollback()
+            job.status = 'failed'
+            job.errors = (job.errors or []) + [[0, f'The file could not be read: {e}']]
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception('Listing import %s failed', job.id)
+            job.status = 'failed'
+        job.finished_at = datetime.utcnow()
+        job.locked_until = None
+        db.session.commit()
+        shutil.rmtree(job.path, ignore_errors=True)
+        return job
+
+    def process_pending(self):
+        count = 0
+        while True:
+            job = self._claim(datetime.utcnow())
+            if job is None:
+                return count
+            self.process(job)
+            count += 1
+
+    def wake(self):
+        app = current_app._get_current_object()
+        if not app.config['LISTING_IMPORT_ASYNC']:
+            # Imports are left to 'flask listings process-imports', e.g. from cron.
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, args=(app,), name='listing-import', daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _work(self, app):
+        while True:
+            self._wakeup.wait(timeout=app.config['LISTING_IMPORT_POLL_INTERVAL'])
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    self.process_pending()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Listing import failed')
+
+
+listing_importer = ListingImporter()
+
+
+@on_commit(ListingImport, key=lambda job: job.id if job.status == 'pending' else None)
+def _imports_queued(job_ids):
+    listing_importer.wake()
+
+
+@listings_cli.command('import')
+@click.argument('shop_name')
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', 'image_folder', type=click.Path(exists=True, file_okay=False),
+              help='Folder the images column refers to; defaults to the CSV file\'s folder.')
+def import_listings(shop_name, csv_file, image_folder):
+    """Import listings into a shop from a CSV file with name, tags and images columns."""
+    shop = Shop.query.filter_by(name_lower=shop_name.lower()).first()
+    if shop is None:
+        raise click.ClickException(f'No shop named {shop_name!r}.')
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+        report = listing_importer.run(
+            shop.id, f, image_folder or os.path.dirname(os.path.abspath(csv_file)),
+            on_batch=lambda report: click.echo(f'{report.rows} rows read, {report.imported} imported', err=True))
+    for line, message in report.errors:
+        click.echo(f'line {line}: {message}')
+    click.echo(f'Imported {report.imported} of {report.rows} rows into {shop.name}; {report.failed} failed.')
+
+
+@listings_cli.command('process-imports')
+def process_imports():
+    """Run every queued listing import."""
+    click.echo(f'Processed {listing_importer.process_pending()} imports.')
@@ -0,0 +1,36 @@
+from flask import request, Blueprint, jsonify, url_for
+from tribezero.database import replica_reads
+from tribezero.reference import reference_data
+from tribezero.images import image_url
+from tribezero.listings.utils import CatalogueFilter, catalogue_page, facet_cache
+
+
+listings = Blueprint('listings', __name__)
+
+
+def listing_json(listing):
+    images = listing.images if isinstance(listing.images, dict) else {}
+    return {'id': listing.id,
+            'name': listing.name,
+            'tags': sorted(tag.name for tag in listing.tag_set),
+            'images': [image_url('listing', image) for image in images.values()],
+            'shop': {'id': listing.shop.id, 'name': listing.shop.name,
+                     'url': url_for('shops.shop', name=listing.shop.name)}}
+
+
+@listings.route("/listings")
+@replica_reads
+def catalogue():
+    catalogue_filter = CatalogueFilter(tags=request.args.getlist('tag'),
+                                       category=request.args.get('category'),
+                                       shop_id=request.args.get('shop', type=int))
+    after = request.args.get('after', type=int)
+    per_page = min(max(request.args.get('per_page', 24, type=int), 1), 100)
+    items, next_cursor = catalogue_page(catalogue_filter, after=after, per_page=per_page)
+    result = {'listings': [listing_json(listing) for listing in items], 'next': next_cursor}
+    if after is None or request.args.get('facets'):
+        facets = facet_cache.get(catalogue_filter)
+        category_names = reference_data.category_names
+        result['facets'] = dict(facets, categories=[dict(category, name=category_names.get(category['code']))
+                                                    for category in facets['categories']])
+    return jsonify(result)
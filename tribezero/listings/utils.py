@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from flask import current_app
+from sqlalchemy import and_, event, func
+from sqlalchemy.orm import Session, attributes, joinedload, selectinload
+from tribezero import db
+from tribezero.database import primary
+from tribezero.hooks import on_commit
+from tribezero.models import Listing, Shop, Tag, listing_tag
+
+
+def normalize_tags(tags):
+    if isinstance(tags, dict):
+        tags = list(tags.values())
+    elif isinstance(tags, str):
+        tags = tags.split(',')
+    elif not isinstance(tags, (list, tuple)):
+        return []
+    names = []
+    for tag in tags:
+        if tag is None:
+            continue
+        name = ' '.join(str(tag).lower().split())[:30]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def tags_by_name(session, names):
+    tags = {tag.name: tag for tag in session.query(Tag).filter(Tag.name.in_(names))} if names else {}
+    for name in set(names) - tags.keys():
+        tags[name] = Tag(name=name, listing_count=0)
+        session.add(tags[name])
+    return tags
+
+
+@event.listens_for(Session, 'before_flush')
+def _sync_listing_tags(session, flush_context, instances):
+    # Keeps listing_tag and Tag.listing_count in step with the Listing.tags JSON column.
+    changed = [obj for obj in session.new if isinstance(obj, Listing)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, Listing) and attributes.get_history(obj, 'tags').has_changes()]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Listing)]
+    if not changed and not deleted:
+        return
+
+    deltas = defaultdict(int)
+    with session.no_autoflush:
+        tags = tags_by_name(session, {name for obj in changed for name in normalize_tags(obj.tags)})
+        for obj in changed:
+            old = set(obj.tag_set)
+            new = [tags[name] for name in normalize_tags(obj.tags)]
+            for tag in set(new) - old:
+                deltas[tag] += 1
+            for tag in old - set(new):
+                deltas[tag] -= 1
+            obj.tag_set = new
+        for obj in deleted:
+            for tag in obj.tag_set:
+                deltas[tag] -= 1
+
+    for tag, delta in deltas.items():
+        if not delta:
+            continue
+        if tag.id is None:
+            tag.listing_count = delta
+        else:
+            tag.listing_count = Tag.listing_count + delta
+
+
+def backfill_listing_tags():
+    count = 0
+    untagged = Listing.query.filter(Listing.tags.isnot(None), ~Listing.tag_set.any())
+    for listing in untagged:
+        if normalize_tags(listing.tags):
+            attributes.flag_modified(listing, 'tags')
+            count += 1
+    return count
+
+
+class CatalogueFilter:
+
+    def __init__(self, tags=(), category=None, shop_id=None):
+        self.tags = tuple(sorted(set(normalize_tags(list(tags)))))
+        self.category = category or None
+        self.shop_id = shop_id
+
+    @property
+    def key(self):
+        return self.tags, self.category, self.shop_id
+
+    def __bool__(self):
+        return bool(self.tags or self.category or self.shop_id)
+
+    def apply(self, query, after=None):
+        # Returns the filtered query ordered newest first, or None when a requested tag does not
+        # exist. With tags, rows are read in order straight off the rarest tag's posting list.
+        order_column = Listing.id
+        if self.tags:
+            tags = Tag.query.filter(Tag.name.in_(self.tags)).all()
+            if len(tags) < len(self.tags):
+                return None
+            for tag in sorted(tags, key=lambda tag: tag.listing_count):
+                postings = listing_tag.alias()
+                query = query.join(postings, and_(postings.c.listing_id == Listing.id, postings.c.tag_id == tag.id))
+                if order_column is Listing.id:
+                    order_column = postings.c.listing_id
+        if self.category:
+            query = query.join(Shop, Shop.id == Listing.shop_id).filter(Shop.shop_categories == self.category)
+        if self.shop_id:
+            query = query.filter(Listing.shop_id == self.shop_id)
+        if after is not None:
+            query = query.filter(order_column < after)
+        return query.order_by(order_column.desc())
+
+
+def catalogue_page(catalogue_filter, after=None, per_page=24):
+    # Keyset pagination, newest listings first; `after` is the id of the last listing already shown.
+    query = catalogue_filter.apply(Listing.query, after=after)
+    if query is None:
+        return [], None
+    items = query.options(joinedload(Listing.shop), selectinload(Listing.tag_set)).limit(per_page + 1).all()
+    next_cursor = items[per_page - 1].id if len(items) > per_page else None
+    return items[:per_page], next_cursor
+
+
+def chunks(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def compute_facets(catalogue_filter, limit, sample):
+    shop_counts = catalogue_filter.apply(db.session.query(Listing.shop_id, func.count()))
+    if shop_counts is None:
+        return {'total': 0, 'tags': [], 'categories': [], 'shops': [], 'sampled': False}
+    shop_counts = dict(shop_counts.order_by(None).group_by(Listing.shop_id).all())
+    total = sum(shop_counts.values())
+
+    shops = {}
+    for shop_ids in chunks(shop_counts):
+        shops.update((shop_id, (name, category)) for shop_id, name, category in
+                     db.session.query(Shop.id, Shop.name, Shop.shop_categories).filter(Shop.id.in_(shop_ids)))
+    category_counts = defaultdict(int)
+    for shop_id, count in shop_counts.items():
+        category_counts[shops[shop_id][1]] += count
+    top_shops = sorted(shop_counts.items(), key=lambda item: (-item[1], shops[item[0]][0]))[:limit]
+
+    sampled = False
+    if catalogue_filter:
+        # Tag co-occurrence costs one posting lookup per matching listing, so very broad filters
+        # count tags over the newest `sample` matches only.
+        sampled = total > sample
+        matching = catalogue_filter.apply(db.session.query(Listing.id)).limit(sample).subquery()
+        tag_rows = db.session.query(Tag.name, func.count())\
+            .join(listing_tag, listing_tag.c.tag_id == Tag.id)\
+            .join(matching, matching.c.id == listing_tag.c.listing_id)\
+            .group_by(Tag.id, Tag.name).order_by(func.count().desc(), Tag.name).limit(limit).all()
+    else:
+        # Unfiltered tag counts are maintained on the tag rows themselves.
+        tag_rows = db.session.query(Tag.name, Tag.listing_count).filter(Tag.listing_count > 0)\
+            .order_by(Tag.listing_count.desc(), Tag.name).limit(limit).all()
+
+    return {'total': total,
+            'sampled': sampled,
+            'tags': [{'name': name, 'count': count} for name, count in tag_rows],
+            'categories': [{'code': code, 'count': count} for code, count in
+                           sorted(category_counts.items(), key=lambda item: (-item[1], item[0] or ''))],
+            'shops': [{'id': shop_id, 'name': shops[shop_id][0], 'count': count} for shop_id, count in top_shops]}
+
+
+class FacetCache:
+    # LRU of facet counts per filter, kept for LISTING_FACET_TTL seconds. Committed listing or shop
+    # changes clear it; the generation check stops a computation that raced a clear from being stored.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._facets = OrderedDict()
+        self._generation = 0
+
+    def get(self, catalogue_filter, limit=20):
+        config = current_app.config
+        key = catalogue_filter.key + (limit,)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._facets.get(key)
+            if entry is not None and entry[0] > now:
+                self._facets.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+        with primary():
+            facets = compute_facets(catalogue_filter, limit, config.get('LISTING_FACET_SAMPLE', 20000))
+        with self._lock:
+            if generation == self._generation:
+                self._facets[key] = (now + config.get('LISTING_FACET_TTL', 300), facets)
+                self._facets.move_to_end(key)
+                while len(self._facets) > config.get('LISTING_FACET_CACHE_SIZE', 1024):
+                    self._facets.popitem(last=False)
+        return facets
+
+    def clear(self):
+        with self._lock:
+            self._facets.clear()
+            self._generation += 1
+
+
+facet_cache = FacetCache()
+
+
+@on_commit(Listing, Tag)
+def _listings_changed(ids):
+    facet_cache.clear()
+
+
+@on_commit(Shop)
+def _shops_changed(shop_ids):
+    facet_cache.clear()
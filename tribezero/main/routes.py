@@ -1,20 +1,28 @@
-from flask import render_template, request, Blueprint, url_for, redirect
+import math
+from flask import render_template, request, Blueprint, url_for, redirect, jsonify, abort, current_app
 from flask_login import current_user
-import requests
 from tribezero.models import Post, CompanyAddress, Shop
 from tribezero.config import Config
 from tribezero import db
+from tribezero.database import replica_reads
+from tribezero.caching import cache
+from tribezero.geo.index import shop_index
+from tribezero.geo.clusters import tile_cache
+from tribezero.reference import reference_data
+from tribezero.posts.feed import feed_page
 
 main = Blueprint('main', __name__)
 
 
 @main.route("/")
 @main.route("/home")
+@cache.page()
 def home():
     return render_template('home.html', title='Home')
 
 
 @main.route("/about")
+@cache.page()
 def about():
     return render_template('about.html', title='About')
 
@@ -27,18 +35,47 @@ def welcome():
 @main.route("/map")
 def sellers_map():
     key = Config.GOOGLE_MAPS_API_KEY
+    return render_template('map.html', title='Map', key=key, marker_icons=reference_data.marker_icons)
 
-    shops = Shop.query.join(CompanyAddress, Shop.id == CompanyAddress.shop_id)\
-        .add_columns(Shop.name, CompanyAddress.company_coordinates_lat, CompanyAddress.company_coordinates_lon,\
-                     CompanyAddress.shop_id, Shop.id, Shop.shop_categories, Shop.description)\
-        .filter(Shop.id == CompanyAddress.shop_id)
-    return render_template('map.html', title='Map', key=key, shops=shops)
+
+@main.route("/map/shops")
+@replica_reads
+def map_shops():
+    try:
+        south = float(request.args['south'])
+        west = float(request.args['west'])
+        north = float(request.args['north'])
+        east = float(request.args['east'])
+    except (KeyError, ValueError):
+        abort(400)
+    # float() accepts 'nan' and 'inf', which the grid index can't place in a cell.
+    if not all(map(math.isfinite, (south, west, north, east))):
+        abort(400)
+    max_markers = current_app.config['MAP_MAX_MARKERS']
+    limit = request.args.get('limit', max_markers, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, max_markers)
+    markers, truncated = shop_index.query_bbox(south, west, north, east, limit=limit)
+    return jsonify(shops=[marker._asdict() for marker in markers], truncated=truncated)
+
+
+@main.route("/map/tiles/<int:z>/<int:x>/<int:y>")
+@replica_reads
+def map_tile(z, x, y):
+    if z > 22 or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    response = jsonify(tile_cache.get(z, x, y))
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 
 @main.route("/blog")
+@cache.page(tags=('post', 'user'))
+@replica_reads
 def blog():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
+    posts = feed_page(Post.query, before=request.args.get('before'), after=request.args.get('after'))
     return render_template('blog.html', posts=posts)
 
 
@@ -0,0 +1,64 @@
+import bisect
+import threading
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Cumulative-bucket histogram in the Prometheus style: counts[i] is the number of
+    # observations <= buckets[i]; the last slot counts everything (the +Inf bucket).
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def render_histogram(name, help_text, series):
+    # `series` is a list of (labels, Histogram.snapshot()) pairs; returns Prometheus text lines.
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for labels, snapshot in series:
+        for bound, count in snapshot['buckets']:
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {snapshot["sum"]}')
+        lines.append(f'{name}_count{format_labels(labels)} {snapshot["count"]}')
+    return lines
+
+
+def render_metric(name, kind, help_text, series):
+    # `kind` is 'counter' or 'gauge'; `series` is a list of (labels, value) pairs.
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for labels, value in series:
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    return lines
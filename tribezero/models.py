@@ -3,11 +3,13 @@ from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import current_app
 from tribezero import db, login_manager
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    from tribezero.users.identity import identity_cache
+    return identity_cache.load(int(user_id))
 
 
 class User(db.Model, UserMixin):
@@ -41,6 +43,8 @@ class User(db.Model, UserMixin):
 
 
 class Post(db.Model):
+    __table_args__ = (db.Index('ix_post_date_posted_id', 'date_posted', 'id'),
+                      db.Index('ix_post_user_id_date_posted_id', 'user_id', 'date_posted', 'id'))
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -54,6 +58,7 @@ class Post(db.Model):
 class Shop(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), unique=True, nullable=False)
+    name_lower = db.Column(db.String(20), unique=True, index=True)
     created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     image_file = db.Column(db.String(20), nullable=False, default='default_shop.jpg')
     total_orders = db.Column(db.Integer, default=0)
@@ -67,12 +72,17 @@ class Shop(db.Model):
     times_favorited = db.Column(db.Integer, default=0)
     times_viewed = db.Column(db.Integer, default=0)
     expired_listings = db.Column(db.Integer, default=0)
-    shop_categories = db.Column(db.String(30), default='None')
+    shop_categories = db.Column(db.String(30), default='None', index=True)
     listing = db.relationship('Listing', backref='shop', lazy=True)
     financial = db.relationship('Financial', backref='shop', lazy=True)
     company_address = db.relationship('CompanyAddress', backref='shop', lazy=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    @validates('name')
+    def validate_name(self, key, name):
+        self.name_lower = name.lower() if name else None
+        return name
+
     def __repr__(self):
         return f"Shop('{self.name}', '{self.id}','{self.user_id}')"
 
@@ -154,10 +164,140 @@ class Account(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
 
+listing_tag = db.Table(
+    'listing_tag',
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Column('listing_id', db.Integer, db.ForeignKey('listing.id'), primary_key=True),
+    db.Index('ix_listing_tag_listing_id_tag_id', 'listing_id', 'tag_id'))
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(30), unique=True, nullable=False)
+    listing_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return f"Tag('{self.name}', '{self.listing_count}')"
+
+
 class Listing(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), nullable=False)
     tags = db.Column(db.JSON)
     images = db.Column(db.JSON, default=lambda: {"image1": "default_listing.jpg"})
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False, index=True)
+    tag_set = db.relationship('Tag', secondary=listing_tag, lazy=True)
+
+
+class ListingImport(db.Model):
+    __table_args__ = (db.Index('ix_listing_import_status_created', 'status', 'created'),)
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.JSON)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    locked_until = db.Column(db.DateTime)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False, index=True)
+
+
+class LedgerEntry(db.Model):
+    __table_args__ = (db.Index('ix_ledger_entry_shop_id_id', 'shop_id', 'id'),
+                      db.Index('ix_ledger_entry_user_id_id', 'user_id', 'id'))
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.BigInteger, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    reference = db.Column(db.String(64))
+    idempotency_key = db.Column(db.String(64), unique=True)
+    reverses_id = db.Column(db.Integer, db.ForeignKey('ledger_entry.id'))
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+
+class ShopBalance(db.Model):
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    sales = db.Column(db.BigInteger, nullable=False, default=0)
+    cancellations = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_sales = db.Column(db.BigInteger, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+    payouts = db.Column(db.Integer, nullable=False, default=0)
+    paid_out = db.Column(db.BigInteger, nullable=False, default=0)
+    amount_due = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class UserBalance(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    purchases = db.Column(db.BigInteger, nullable=False, default=0)
+    cancellations = db.Column(db.Integer, nullable=False, default=0)
+    refunded = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class GeocodedAddress(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(1000), unique=True, nullable=False)
+    lat = db.Column(db.Float())
+    lon = db.Column(db.Float())
+    provider = db.Column(db.String(20))
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class OutboxMessage(db.Model):
+    __sticky_writes__ = False
+    __table_args__ = (db.Index('ix_outbox_message_status_next_attempt', 'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(120), nullable=False)
+    recipients = db.Column(db.Text, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    dedupe_key = db.Column(db.String(120), index=True)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+
+class ShopEvent(db.Model):
+    __sticky_writes__ = False
+    __table_args__ = (db.Index('ix_shop_event_shop_id_created', 'shop_id', 'created'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Integer, nullable=False, default=1)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+
+
+class ShopDailyStat(db.Model):
+    __table_args__ = (db.UniqueConstraint('shop_id', 'kind', 'period', name='uq_shop_daily_stat'),)
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    events = db.Column(db.Integer, nullable=False, default=0)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+
+
+class ShopWeeklyStat(db.Model):
+    __table_args__ = (db.UniqueConstraint('shop_id', 'kind', 'period', name='uq_shop_weekly_stat'),)
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    events = db.Column(db.Integer, nullable=False, default=0)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+
 
+class RollupState(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)
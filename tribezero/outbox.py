@@ -0,0 +1,231 @@
+import smtplib
+import socketserver
+import threading
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_mail import Message
+from sqlalchemy import or_
+from tribezero import db, mail
+from tribezero.hooks import on_commit
+from tribezero.models import OutboxMessage
+
+
+outbox_cli = AppGroup('outbox', help='Outgoing e-mail queue.')
+
+
+class Outbox:
+    # E-mails are written to the outbox_message table in the caller's transaction and delivered
+    # by a background thread once that transaction commits. Each batch goes out over a single
+    # SMTP connection; failed messages are retried with exponential backoff.
+
+    def __init__(self, app=None):
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OUTBOX_ASYNC', True)
+        app.config.setdefault('OUTBOX_BATCH_SIZE', 50)
+        app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 6)
+        app.config.setdefault('OUTBOX_RETRY_DELAY', 30)
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 30)
+        app.config.setdefault('OUTBOX_LOCK_SECONDS', 300)
+        app.config.setdefault('OUTBOX_DEDUPE_WINDOW', 900)
+
+    def queue(self, subject, recipients, body, sender, dedupe_key=None):
+        if dedupe_key is not None:
+            window = datetime.utcnow() - timedelta(seconds=current_app.config['OUTBOX_DEDUPE_WINDOW'])
+            duplicate = OutboxMessage.query.filter(OutboxMessage.dedupe_key == dedupe_key,
+                                                   OutboxMessage.status != 'failed',
+                                                   OutboxMessage.created >= window).first()
+            if duplicate is not None:
+                return duplicate
+        message = OutboxMessage(subject=subject, recipients=','.join(recipients), body=body,
+                                sender=sender, dedupe_key=dedupe_key, status='pending')
+        db.session.add(message)
+        return message
+
+    def _claim(self, now, limit):
+        lock_until = now + timedelta(seconds=current_app.config['OUTBOX_LOCK_SECONDS'])
+        due = OutboxMessage.query.with_entities(OutboxMessage.id)\
+            .filter(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now,
+                    or_(OutboxMessage.locked_until.is_(None), OutboxMessage.locked_until < now))\
+            .order_by(OutboxMessage.next_attempt_at).limit(limit).all()
+        claimed = []
+        for (message_id,) in due:
+            # Conditional update, so two senders polling the same table never both take a message.
+            updated = OutboxMessage.query.filter(OutboxMessage.id == message_id,
+                                                 or_(OutboxMessage.locked_until.is_(None),
+                                                     OutboxMessage.locked_until < now))\
+                .update({'locked_until': lock_until}, synchronize_session=False)
+            if updated:
+                claimed.append(message_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return OutboxMessage.query.filter(OutboxMessage.id.in_(claimed)).all()
+
+    def _failed(self, message, error, now):
+        message.attempts += 1
+        message.last_error = str(error)
+        message.locked_until = None
+        if message.attempts >= current_app.config['OUTBOX_MAX_ATTEMPTS']:
+            message.status = 'failed'
+        else:
+            delay = current_app.config['OUTBOX_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+            message.next_attempt_at = now + timedelta(seconds=delay)
+
+    def deliver_batch(self):
+        now = datetime.utcnow()
+        batch = self._claim(now, current_app.config['OUTBOX_BATCH_SIZE'])
+        if not batch:
+            return 0
+        try:
+            with mail.connect() as connection:
+                for message in batch:
+                    try:
+                        connection.send(Message(message.subject, sender=message.sender,
+                                                recipients=message.recipients.split(','), body=message.body))
+                    except smtplib.SMTPRecipientsRefused as e:
+                        self._failed(message, e, now)
+                        message.status = 'failed'
+                    except (smtplib.SMTPException, OSError) as e:
+                        self._failed(message, e, now)
+                    else:
+                        message.status = 'sent'
+                        message.sent_at = datetime.utcnow()
+                        message.locked_until = None
+        except (smtplib.SMTPException, OSError) as e:
+            current_app.logger.warning('SMTP connection failed: %s', e)
+            for message in batch:
+                if message.status == 'pending' and message.locked_until is not None:
+                    self._failed(message, e, now)
+        db.session.commit()
+        return len(batch)
+
+    def deliver_pending(self):
+        total = 0
+        while True:
+            sent = self.deliver_batch()
+            total += sent
+            if not sent:
+                return total
+
+    def wake(self):
+        app = current_app._get_current_object()
+        if not app.config['OUTBOX_ASYNC']:
+            # Delivery is left to 'flask outbox send', e.g. from cron.
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, args=(app,), name='outbox', daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _work(self, app):
+        while True:
+            self._wakeup.wait(timeout=app.config['OUTBOX_POLL_INTERVAL'])
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    self.deliver_pending()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Outbox delivery failed')
+
+
+outbox = Outbox()
+
+
+@on_commit(OutboxMessage, key=lambda message: message.id if message.status == 'pending' else None)
+def _messages_queued(message_ids):
+    outbox.wake()
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    # Minimal SMTP server that accepts every message and keeps it in memory. Point MAIL_SERVER
+    # and MAIL_PORT at it in development and tests instead of a real relay.
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=1025, delay=0, on_message=None):
+        self.messages = []
+        self.delay = delay
+        self.on_message = on_message
+        super().__init__((host, port), SMTPSinkHandler)
+
+    def received(self, message):
+        self.messages.append(message)
+        if self.on_message is not None:
+            self.on_message(message)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+        return self
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 tribezero smtp sink')
+        envelope = {'from': None, 'to': []}
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 tribezero')
+            elif verb == 'MAIL':
+                envelope = {'from': command[10:].strip(' <>'), 'to': []}
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                envelope['to'].append(command[8:].strip(' <>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                if self.server.delay:
+                    threading.Event().wait(self.server.delay)
+                self.server.received(dict(envelope, data=b''.join(data)))
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            else:
+                self.reply('502 Command not implemented')
+
+
+@outbox_cli.command('send')
+def send():
+    """Deliver every message that is due now."""
+    click.echo(f'Processed {outbox.deliver_pending()} messages.')
+
+
+@outbox_cli.command('sink')
+@click.option('--host', default='localhost', show_default=True)
+@click.option('--port', default=1025, show_default=True)
+def sink(host, port):
+    """Run a local SMTP server that accepts and prints every message."""
+    server = SMTPSink(host, port, on_message=lambda message: click.echo(message['data'].decode('utf-8', 'replace')))
+    click.echo(f'SMTP sink listening on {host}:{port}')
+    try:
+        server.serve_forever(poll_interval=0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,97 @@
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+from tribezero.database import primary
+from tribezero.hooks import on_commit
+from tribezero.models import Post
+
+
+def encode_cursor(post):
+    return f'{post.date_posted.isoformat()}_{post.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        date_posted, post_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(date_posted), int(post_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class FeedPage:
+
+    def __init__(self, items, has_newer, has_older, total=None):
+        self.items = items
+        self.has_newer = has_newer
+        self.has_older = has_older
+        self.total = total
+
+    @property
+    def newer_cursor(self):
+        return encode_cursor(self.items[0]) if self.items else None
+
+    @property
+    def older_cursor(self):
+        return encode_cursor(self.items[-1]) if self.items else None
+
+
+def feed_page(query, before=None, after=None, per_page=5):
+    # Keyset pagination over (date_posted, id), newest first. `before` pages towards older posts,
+    # `after` towards newer ones; both are cursors taken from a previous page.
+    query = query.options(joinedload(Post.author))
+    before, after = decode_cursor(before), decode_cursor(after)
+    if after is not None:
+        date_posted, post_id = after
+        items = query.filter(or_(Post.date_posted > date_posted,
+                                 and_(Post.date_posted == date_posted, Post.id > post_id)))\
+            .order_by(Post.date_posted.asc(), Post.id.asc()).limit(per_page + 1).all()
+        has_newer = len(items) > per_page
+        items = items[:per_page][::-1]
+        return FeedPage(items, has_newer=has_newer, has_older=True)
+
+    if before is not None:
+        date_posted, post_id = before
+        query = query.filter(or_(Post.date_posted < date_posted,
+                                 and_(Post.date_posted == date_posted, Post.id < post_id)))
+    items = query.order_by(Post.date_posted.desc(), Post.id.desc()).limit(per_page + 1).all()
+    return FeedPage(items[:per_page], has_newer=before is not None, has_older=len(items) > per_page)
+
+
+class CountCache:
+    # Remembers COUNT(*) results for FEED_COUNT_TTL seconds; any committed Post change clears it.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._generation = 0
+
+    def get(self, key, query):
+        ttl = current_app.config.get('FEED_COUNT_TTL', 300)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            generation = self._generation
+        with primary():
+            count = query.order_by(None).count()
+        with self._lock:
+            if generation == self._generation:
+                self._counts[key] = (now + ttl, count)
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self._generation += 1
+
+
+post_counts = CountCache()
+
+
+@on_commit(Post)
+def _posts_changed(post_ids):
+    post_counts.clear()
@@ -2,6 +2,7 @@ from flask import (render_template, url_for, flash,
                    redirect, request, abort, Blueprint)
 from flask_login import current_user, login_required
 from tribezero import db
+from tribezero.database import replica_reads
 from tribezero.models import Post
 from tribezero.posts.forms import PostForm
 
@@ -23,6 +24,7 @@ def new_post():
 
 
 @posts.route("/post/<int:post_id>")
+@replica_reads
 def post(post_id):
     post = Post.query.get_or_404(post_id)
     return render_template('post.html', title=post.title, post=post)
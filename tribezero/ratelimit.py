@@ -0,0 +1,216 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from tribezero.metrics import render_metric
+
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LIMIT = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*(?:burst\s+(\d+))?\s*$')
+
+
+class RateLimited(TooManyRequests):
+    # Werkzeug only takes retry_after from 1.0 on, so it is kept here for the 429 handler.
+    description = 'You are doing that too often. Please wait a moment and try again.'
+
+    def __init__(self, retry_after=None):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+def parse_limit(limit):
+    # '5/minute', '100/hour', '10/15 minutes', '5/minute burst 10' -> (tokens per second, capacity).
+    match = LIMIT.match(limit)
+    if match is None:
+        raise ValueError(f'Invalid rate limit {limit!r}')
+    count, multiple, period, burst = match.groups()
+    seconds = int(multiple or 1) * PERIODS[period]
+    return int(count) / seconds, int(burst or count)
+
+
+def take(state, now, rate, capacity, cost):
+    # Token bucket: `state` is (tokens, updated) or None for a full bucket. Returns the new state
+    # and how long to wait, 0 when the request may go ahead.
+    tokens, updated = state if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= cost:
+        return (tokens - cost, now), 0
+    return (tokens, now), (cost - tokens) / rate
+
+
+class MemoryBuckets:
+    # Per-process buckets. With several workers each one allows the full rate, so use the SQLite
+    # backend to enforce limits across a deployment.
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, buckets, cost=1):
+        # `buckets` is a list of (key, rate, capacity). Tokens are only taken if every bucket has
+        # them; otherwise nothing changes and the longest wait is returned.
+        now = time.monotonic()
+        with self._lock:
+            results = [(key,) + take(self._buckets.get(key), now, rate, capacity, cost)
+                       for key, rate, capacity in buckets]
+            wait = max((wait for _, _, wait in results), default=0)
+            if wait:
+                return wait
+            for key, state, _ in results:
+                self._buckets[key] = state
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    # Buckets in a small SQLite file of their own, shared by every worker on the host and kept out
+    # of the main database's write lock. Each take is one short IMMEDIATE transaction on a
+    # per-thread connection; rows idle for a day are pruned now and then.
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Set up with a throwaway connection, so a worker forked after init_app opens its own.
+        connection = sqlite3.connect(path, timeout=5)
+        try:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = wal')
+            # Losing a few seconds of bucket state in a crash only makes limits briefly lenient.
+            connection.execute('PRAGMA synchronous = off')
+            self._local.connection = connection
+        return connection
+
+    def take(self, buckets, cost=1):
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            results = []
+            for key, rate, capacity in buckets:
+                row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+                results.append((key,) + take(row, now, rate, capacity, cost))
+            wait = max((wait for _, _, wait in results), default=0)
+            if not wait:
+                connection.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                                       [(key, state[0], state[1]) for key, state, _ in results])
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - PERIODS['day'],))
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            # The bucket file stayed locked past the timeout: let the request through rather
+            # than fail it because of the limiter.
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            return 0
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._connect().execute('DELETE FROM bucket')
+
+
+class RateLimiter:
+    # Token buckets per client IP, per account and per endpoint, checked before the view runs so
+    # a rejected request costs a bucket update and nothing else: no form parsing beyond the
+    # e-mail field, no bcrypt, no SMTP, no geocoding. Limits given to the decorator can be
+    # overridden per endpoint with RATELIMIT_LIMITS = {'login': {'ip': '10/minute'}}.
+
+    def __init__(self, app=None):
+        self.backend = MemoryBuckets()
+        self._lock = threading.Lock()
+        self.rejected = defaultdict(int)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_BACKEND', 'memory')
+        app.config.setdefault('RATELIMIT_STORAGE', os.path.join(app.instance_path, 'ratelimit.db'))
+        app.config.setdefault('RATELIMIT_MAX_KEYS', 100000)
+        app.config.setdefault('RATELIMIT_LIMITS', {})
+        backend = app.config['RATELIMIT_BACKEND']
+        if backend == 'memory':
+            self.backend = MemoryBuckets(app.config['RATELIMIT_MAX_KEYS'])
+        elif backend == 'sqlite':
+            self.backend = SQLiteBuckets(app.config['RATELIMIT_STORAGE'])
+        else:
+            raise ValueError(f'Unknown RATELIMIT_BACKEND {backend!r}')
+
+    def check(self, name, limits, cost=1):
+        # Takes from every bucket that applies, or from none of them: a client refused by its IP
+        # bucket doesn't drain the shared account and endpoint buckets. Raises RateLimited with the
+        # longest wait.
+        limits = dict(limits, **current_app.config['RATELIMIT_LIMITS'].get(name, {}))
+        buckets = []
+        for scope, key in (('ip', request.remote_addr or '-'), ('account', account_key()), ('endpoint', '*')):
+            if key is None or not limits.get(scope):
+                continue
+            buckets.append((f'{name}:{scope}:{key}',) + parse_limit(limits[scope]))
+        wait = self.backend.take(buckets, cost) if buckets else 0
+        if wait:
+            with self._lock:
+                self.rejected[name] += 1
+            raise RateLimited(retry_after=math.ceil(wait))
+
+    def limit(self, name, ip=None, account=None, endpoint=None, methods=('POST',)):
+        # Only the methods that do the expensive work are limited; showing the form stays free.
+        limits = {'ip': ip, 'account': account, 'endpoint': endpoint}
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if current_app.config['RATELIMIT_ENABLED'] and request.method in methods:
+                    self.check(name, limits)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def render(self):
+        with self._lock:
+            rejected = dict(self.rejected)
+        return render_metric('tribezero_ratelimit_rejected_total', 'counter', 'Requests refused by a rate limit.',
+                             [({'limit': name}, count) for name, count in sorted(rejected.items())])
+
+
+def account_key():
+    # The signed-in user, or the e-mail address a sign-in, sign-up or reset is for. Addresses are
+    # hashed so the shared bucket file holds no personal data.
+    if current_user.is_authenticated:
+        return f'user:{current_user.get_id()}'
+    email = request.form.get('email', '').strip().lower()
+    if not email:
+        return None
+    return 'email:' + hashlib.sha256(email.encode('utf-8')).hexdigest()[:32]
+
+
+limiter = RateLimiter()
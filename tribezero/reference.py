@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+class ReferenceData:
+    # Countries and shop categories from the JSON files in static/. Nothing is read until the first
+    # lookup, and paths are resolved against the package, so importing forms or routes is cheap and
+    # works from any working directory. Each file is parsed once per process.
+
+    def __init__(self, folder=STATIC_FOLDER):
+        self.folder = folder
+        self._lock = threading.RLock()
+        self._loaded = {}
+
+    def _load(self, name, build):
+        value = self._loaded.get(name)
+        if value is None:
+            with self._lock:
+                value = self._loaded.get(name)
+                if value is None:
+                    value = self._loaded[name] = build()
+        return value
+
+    def _read(self, filename, code_key, name_key):
+        with open(os.path.join(self.folder, filename), 'r', encoding='utf-8') as f:
+            return [(item[code_key], item[name_key]) for item in json.load(f)]
+
+    @property
+    def countries(self):
+        return self._load('countries', lambda: self._read('countries.json', 'code', 'name'))
+
+    @property
+    def categories(self):
+        return self._load('categories', lambda: self._read('shop_categories.json', 'code', 'category'))
+
+    @property
+    def country_names(self):
+        return self._load('country_names', lambda: dict(self.countries))
+
+    @property
+    def category_names(self):
+        return self._load('category_names', lambda: dict(self.categories))
+
+    @property
+    def marker_icons(self):
+        # Category code -> marker icon under static/marker_icons, for the categories that have one.
+        def build():
+            icons = {}
+            for code, _ in self.categories:
+                filename = f'{code}_icon.png'
+                if os.path.exists(os.path.join(self.folder, 'marker_icons', filename)):
+                    icons[code] = filename
+            return icons
+        return self._load('marker_icons', build)
+
+    def clear(self):
+        with self._lock:
+            self._loaded = {}
+
+
+reference_data = ReferenceData()
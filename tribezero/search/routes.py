@@ -0,0 +1,16 @@
+from flask import render_template, request, Blueprint
+from tribezero.database import replica_reads
+from tribezero.search.utils import search as search_index
+
+
+search = Blueprint('search', __name__)
+
+
+@search.route("/search")
+@replica_reads
+def results():
+    query = request.args.get('q', '').strip()
+    doc_type = request.args.get('type')
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits = search_index(query, doc_type=doc_type, page=page) if query else []
+    return render_template('search.html', title='Search', query=query, doc_type=doc_type, hits=hits, page=page)
@@ -0,0 +1,158 @@
+import re
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+from sqlalchemy import event, text
+from sqlalchemy.orm import joinedload
+from tribezero import db
+from tribezero.models import Post, Shop, Listing
+
+
+# One SQLite FTS5 table holds every searchable document. The rowid packs the document type into
+# its low bits so rows can be replaced or deleted by primary key without scanning the index.
+DOC_TYPES = {'post': 1, 'shop': 2, 'listing': 3}
+DOC_TYPE_NAMES = {code: name for name, code in DOC_TYPES.items()}
+INDEXED_FIELDS = {Post: ('title', 'content'), Shop: ('name', 'description'), Listing: ('name', 'tags')}
+
+CREATE_INDEX = """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    title, body, tokenize='unicode61 remove_diacritics 1', prefix='2 3')"""
+
+search_cli = AppGroup('search', help='Full-text search index maintenance.')
+_ready = set()
+
+
+def listing_tags(tags):
+    if isinstance(tags, dict):
+        tags = list(tags.values())
+    if isinstance(tags, (list, tuple)):
+        return ' '.join(str(tag) for tag in tags if tag is not None)
+    return str(tags or '')
+
+
+def document(obj):
+    if isinstance(obj, Post):
+        return 'post', obj.title, obj.content
+    if isinstance(obj, Shop):
+        return 'shop', obj.name, obj.description or ''
+    return 'listing', obj.name, listing_tags(obj.tags)
+
+
+def rowid(doc_type, doc_id):
+    return doc_id * 4 + DOC_TYPES[doc_type]
+
+
+def ensure_index(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    key = str(connection.engine.url)
+    if key not in _ready:
+        connection.execute(text(CREATE_INDEX))
+        # Created inside an open transaction the table still goes away if that rolls back, so it
+        # is only remembered once it was created outside one, i.e. already committed.
+        if not connection.connection.in_transaction:
+            _ready.add(key)
+    return True
+
+
+def index_document(connection, obj):
+    index_documents(connection, [obj])
+
+
+def index_documents(connection, objs):
+    if not objs or not ensure_index(connection):
+        return
+    rows = []
+    for obj in objs:
+        doc_type, title, body = document(obj)
+        rows.append({'rowid': rowid(doc_type, obj.id), 'title': title, 'body': body})
+    connection.execute(text('INSERT OR REPLACE INTO search_index(rowid, title, body) VALUES (:rowid, :title, :body)'),
+                       rows)
+
+
+def remove_document(connection, obj):
+    if not ensure_index(connection):
+        return
+    doc_type = document(obj)[0]
+    connection.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), rowid=rowid(doc_type, obj.id))
+
+
+def _after_insert(mapper, connection, target):
+    index_document(connection, target)
+
+
+def _after_update(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS[type(target)]):
+        index_document(connection, target)
+
+
+def _after_delete(mapper, connection, target):
+    remove_document(connection, target)
+
+
+for model in INDEXED_FIELDS:
+    event.listen(model, 'after_insert', _after_insert)
+    event.listen(model, 'after_update', _after_update)
+    event.listen(model, 'after_delete', _after_delete)
+
+
+def match_expression(query):
+    # Quote every word so user input can never be parsed as FTS5 syntax; the last word is a prefix.
+    words = re.findall(r'\w+', query.lower())[:10]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+
+def search(query, doc_type=None, page=1, per_page=20):
+    expression = match_expression(query)
+    if expression is None or not ensure_index(db.session.connection()):
+        return []
+    where = 'search_index MATCH :expression'
+    params = {'expression': expression, 'limit': per_page, 'offset': (page - 1) * per_page}
+    if doc_type in DOC_TYPES:
+        where += ' AND rowid % 4 = :code'
+        params['code'] = DOC_TYPES[doc_type]
+    rows = db.session.execute(text(
+        "SELECT rowid, snippet(search_index, 1, char(2), char(3), '...', 16) "
+        f"FROM search_index WHERE {where} ORDER BY bm25(search_index, 5.0, 1.0) "
+        "LIMIT :limit OFFSET :offset"), params).fetchall()
+
+    hits = [(DOC_TYPE_NAMES[row[0] % 4], row[0] // 4, highlight(row[1])) for row in rows]
+    objects = {}
+    # Listing results link to their shop, so shops are loaded with them rather than one by one.
+    for name, model, options in (('post', Post, ()), ('shop', Shop, ()),
+                                 ('listing', Listing, (joinedload(Listing.shop),))):
+        ids = [doc_id for hit_type, doc_id, _ in hits if hit_type == name]
+        if ids:
+            objects.update({(name, obj.id): obj for obj in model.query.options(*options).filter(model.id.in_(ids))})
+    return [(doc_type, objects[(doc_type, doc_id)], snippet)
+            for doc_type, doc_id, snippet in hits if (doc_type, doc_id) in objects]
+
+
+def rebuild_index(batch_size=1000):
+    connection = db.session.connection()
+    if not ensure_index(connection):
+        return 0
+    connection.execute(text('DELETE FROM search_index'))
+    total = 0
+    for model in (Post, Shop, Listing):
+        for obj in model.query.order_by(model.id).yield_per(batch_size):
+            index_document(connection, obj)
+            total += 1
+    connection.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+    db.session.commit()
+    return total
+
+
+@search_cli.command('rebuild')
+@click.option('--batch-size', default=1000, show_default=True)
+def rebuild(batch_size):
+    """Rebuild the full-text search index from posts, shops and listings."""
+    click.echo(f'Indexed {rebuild_index(batch_size)} documents.')
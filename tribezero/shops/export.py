@@ -0,0 +1,103 @@
+import csv
+import io
+import json
+import zlib
+from collections import namedtuple
+from datetime import date, datetime
+from flask import current_app, Response, stream_with_context
+from sqlalchemy import cast, Text
+from werkzeug.utils import secure_filename
+from tribezero.models import Listing, Financial, ShopDailyStat
+
+
+Export = namedtuple('Export', ['columns', 'query', 'json_columns'])
+
+EXPORTS = {
+    # JSON columns are selected as their stored text and written out as is; decoding and
+    # re-encoding them took most of the time of a large listings export.
+    'listings': Export(('id', 'name', 'tags', 'images'), lambda shop_id: Listing.query
+                       .with_entities(Listing.id, Listing.name, cast(Listing.tags, Text), cast(Listing.images, Text))
+                       .filter(Listing.shop_id == shop_id).order_by(Listing.id), {'tags', 'images'}),
+    'sales': Export(('date', 'kind', 'total', 'events'), lambda shop_id: ShopDailyStat.query
+                    .with_entities(ShopDailyStat.period, ShopDailyStat.kind, ShopDailyStat.total, ShopDailyStat.events)
+                    .filter(ShopDailyStat.shop_id == shop_id).order_by(ShopDailyStat.period, ShopDailyStat.kind),
+                    set()),
+    'financials': Export(('id', 'vat_id', 'taxpayer_id', 'revenue', 'paypal_account', 'amount_due'),
+                         lambda shop_id: Financial.query
+                         .with_entities(Financial.id, Financial.vat_id, Financial.taxpayer_id, Financial.revenue,
+                                        Financial.paypal_account, Financial.amount_due)
+                         .filter(Financial.shop_id == shop_id).order_by(Financial.id), set()),
+}
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+CHUNK_SIZE = 64 * 1024
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+encode_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def plain_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_value(value):
+    if type(value) is str:
+        # Shop owners open these in spreadsheets, which would run a leading formula character.
+        return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+    return plain_value(value)
+
+
+def csv_chunks(export, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export.columns)
+    raw = tuple(column in export.json_columns for column in export.columns)
+    for row in rows:
+        writer.writerow([value if is_json else csv_value(value) for value, is_json in zip(row, raw)])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(export, rows):
+    keys = tuple((encode_json(column) + ':', column in export.json_columns) for column in export.columns)
+    lines, size = [], 0
+    for row in rows:
+        line = '{' + ','.join(key + ((value or 'null') if is_json else encode_json(plain_value(value)))
+                              for (key, is_json), value in zip(keys, row)) + '}\n'
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(lines).encode('utf-8')
+            lines, size = [], 0
+    yield ''.join(lines).encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(shop, dataset, fmt, gzip=False):
+    # Rows are read with yield_per, which also asks the driver for a server-side cursor, and
+    # written out in CHUNK_SIZE pieces as they arrive, so memory doesn't grow with the shop.
+    export = EXPORTS[dataset]
+    rows = export.query(shop.id).yield_per(current_app.config.get('EXPORT_BATCH_SIZE', 1000))
+    chunks = (csv_chunks if fmt == 'csv' else ndjson_chunks)(export, rows)
+    filename = f'{secure_filename(shop.name) or "shop"}-{dataset}-{date.today().isoformat()}.{fmt}'
+    mimetype = FORMATS[fmt]
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
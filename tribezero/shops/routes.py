@@ -1,12 +1,23 @@
 from datetime import datetime
-from sqlalchemy import func
-from flask import render_template, url_for, flash, redirect, request, Blueprint
+from flask import render_template, url_for, flash, redirect, request, Blueprint, jsonify, abort, current_app
 from flask_login import current_user, login_required
+from sqlalchemy.orm import joinedload
 from tribezero import db
-from tribezero.users.forms import CreateShopForm
-from tribezero.models import Shop, CompanyAddress, Contact
-from tribezero.config import Config
-import requests
+from tribezero.database import replica_reads
+from tribezero.caching import cache, conditional
+from tribezero.users.forms import CreateShopForm, ImportListingsForm
+from tribezero.models import Shop, CompanyAddress, Contact, ListingImport
+from tribezero.reference import reference_data
+from tribezero.geo.geocoding import geocoder, address_string
+from tribezero.geo.index import shop_index
+from tribezero.geo.nearby import nearby_shops
+from tribezero.shops.utils import shop_by_name
+from tribezero.shops.stats import shop_stats
+from tribezero.shops.export import export_response, EXPORTS, FORMATS
+from tribezero.listings.imports import listing_importer
+from tribezero.shops.typeahead import shop_typeahead
+from tribezero.counters import counters
+from tribezero.ratelimit import limiter
 
 
 user_shops = Blueprint('shops', __name__)
@@ -14,6 +25,7 @@ user_shops = Blueprint('shops', __name__)
 
 @user_shops.route("/open_shop", methods=['GET', 'POST'])
 @login_required
+@limiter.limit('open_shop', ip='20/hour', account='10/hour', endpoint='60/minute')
 def open_shop():
     form = CreateShopForm(company_country="IE")
 
@@ -28,13 +40,6 @@ def open_shop():
                     shop_categories=form.shop_categories.data
                     )
 
-        key = Config.GOOGLE_MAPS_API_KEY
-        google_maps_api_url = "https://maps.googleapis.com/maps/api/geocode/json?"
-        address = f"address={form.company_street_line1.data},{form.company_street_line2.data},{form.company_city.data}," \
-            f"{form.company_region.data},{form.company_zip_code.data},{dict(form.company_country.choices).get(form.company_country.data)}"
-        coordinates_response = requests.get(google_maps_api_url + address + "&key=" + key).json()
-        response = coordinates_response["results"][0]
-
         company_address = CompanyAddress(company_name=form.company_name.data,
                                          company_street_line1=form.company_street_line1.data,
                                          company_street_line2=form.company_street_line2.data,
@@ -44,41 +49,146 @@ def open_shop():
                                          company_zip_code=form.company_zip_code.data,
                                          company_building_number=form.company_building_number.data,
                                          company_apartment_number=form.company_apartment_number.data,
-                                         company_coordinates_lat=response["geometry"]["location"]["lat"],
-                                         company_coordinates_lon=response["geometry"]["location"]["lng"],
-                                         shop=current_user)
+                                         shop=shop)
+
+        country_name = dict(form.company_country.choices).get(form.company_country.data)
+        found, coordinates = geocoder.cached(address_string(company_address, country_name))
+        if coordinates:
+            company_address.company_coordinates_lat, company_address.company_coordinates_lon = coordinates
 
         contact = Contact(email=form.email.data,
-                          shop=current_user)
+                          owner=current_user)
 
         db.session.add(shop)
         db.session.add(company_address)
         db.session.add(contact)
         db.session.commit()
 
+        if not found:
+            geocoder.enqueue(company_address.id)
+
         flash('Your shop has been opened!', 'success')
         return redirect(url_for('main.home'))
     return render_template('open_shop.html', title='Open Shop', form=form)
 
 
 @user_shops.route("/shop/<string:name>")
+@conditional
 def shop(name):
-    shop_id = Shop.query.filter(func.lower(Shop.name) == func.lower(name)).first().id
-    shop_info = Shop.query.get_or_404(shop_id)
+    shop_info = shop_by_name(name)
+    if shop_info is None:
+        abort(404)
+    counters.incr(Shop.times_viewed, shop_info.id)
+    shop_stats.record_later(shop_info.id, 'view')
     return render_template('shop.html', title=name, shop_info=shop_info)
 
 
 @user_shops.route("/shops")
+@cache.page(tags=('shop', 'user'))
+@replica_reads
 def shops():
     page = request.args.get('page', 1, type=int)
-    shops = Shop.query.order_by(Shop.name.asc()).paginate(page=page, per_page=10)
+    shops = Shop.query.options(joinedload(Shop.owner)).order_by(Shop.name.asc()).paginate(page=page, per_page=10)
     return render_template('shops.html', title='Shops', shops=shops)
 
 
+@user_shops.route("/shops/autocomplete")
+def autocomplete():
+    limit = min(max(request.args.get('limit', current_app.config['TYPEAHEAD_LIMIT'], type=int), 1), 20)
+    suggestions = shop_typeahead.suggest(request.args.get('q', ''), limit=limit)
+    for suggestion in suggestions:
+        if suggestion['type'] == 'shop':
+            suggestion['url'] = url_for('shops.shop', name=suggestion['label'])
+    return jsonify(suggestions=suggestions)
+
+
 @user_shops.route("/shop_manager")
 @login_required
 def shop_manager():
-    users_shop = Shop.query.filter_by(owner=current_user).first().name
-    return render_template('shop_manager.html', title=users_shop, users_shop=users_shop)
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    imports = ListingImport.query.filter_by(shop_id=users_shop.id).order_by(ListingImport.id.desc()).limit(5).all()
+    return render_template('shop_manager.html', title=users_shop.name, users_shop=users_shop.name,
+                           form=ImportListingsForm(), imports=imports)
+
+
+@user_shops.route("/shop_manager/import", methods=['POST'])
+@login_required
+def import_listings():
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    form = ImportListingsForm()
+    if form.validate_on_submit():
+        job = listing_importer.enqueue(users_shop, form.listings_file.data, form.images.data)
+        db.session.commit()
+        flash('Your listings are being imported. This page shows the progress.', 'success')
+        return redirect(url_for('shops.shop_manager', import_id=job.id))
+    for errors in form.errors.values():
+        for error in errors:
+            flash(error, 'danger')
+    return redirect(url_for('shops.shop_manager'))
 
 
+@user_shops.route("/shop_manager/import/<int:import_id>")
+@login_required
+def import_status(import_id):
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    job = ListingImport.query.filter_by(id=import_id, shop_id=users_shop.id).first_or_404()
+    return jsonify(id=job.id, status=job.status, rows=job.rows, imported=job.imported, failed=job.failed,
+                   errors=[{'line': line, 'message': message} for line, message in job.errors or []])
+
+
+@user_shops.route("/shop_manager/stats")
+@login_required
+def stats():
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    return render_template('stats.html', title=users_shop.name,
+                           chart=shop_stats.series(users_shop.id, period='day', count=30))
+
+
+@user_shops.route("/shop_manager/stats/series")
+@login_required
+def stats_series():
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'week'):
+        abort(400)
+    count = min(max(request.args.get('count', 30, type=int), 1), 366 if period == 'day' else 104)
+    return jsonify(shop_stats.series(users_shop.id, period=period, count=count))
+
+
+@user_shops.route("/shop_manager/export/<string:dataset>")
+@login_required
+def export(dataset):
+    users_shop = Shop.query.filter_by(owner=current_user).first_or_404()
+    fmt = request.args.get('format', 'csv')
+    if dataset not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+    return export_response(users_shop, dataset, fmt, gzip=request.args.get('gzip', 0, type=int) == 1)
+
+
+@user_shops.route("/nearby")
+def nearby():
+    return render_template('nearby.html', title='Shops Near You', categories=reference_data.categories)
+
+
+@user_shops.route("/nearby/shops")
+def nearby_shops_json():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radius = request.args.get('radius', 25.0, type=float)
+    limit = request.args.get('limit', 20, type=int)
+    category = request.args.get('category') or None
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        abort(400)
+    if category is not None and category not in reference_data.category_names:
+        abort(400)
+    radius = min(max(radius, 0.1), 500.0)
+    limit = min(max(limit, 1), 100)
+
+    results = []
+    for shop_id, distance in nearby_shops.query(lat, lon, radius, category=category, limit=limit):
+        marker = shop_index.get(shop_id)
+        if marker is None:
+            continue
+        results.append(dict(marker._asdict(), distance_km=round(distance, 3),
+                            url=url_for('shops.shop', name=marker.name)))
+    return jsonify(shops=results)
@@ -0,0 +1,190 @@
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from tribezero import db
+from tribezero.counters import counters
+from tribezero.hooks import on_commit
+from tribezero.models import ShopEvent, ShopDailyStat, ShopWeeklyStat, RollupState
+
+
+stats_cli = AppGroup('stats', help='Shop statistics rollups.')
+
+EVENT_KINDS = ('view', 'favorite', 'order', 'sale', 'cancel')
+ROLLUP = 'shop_events'
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+class ShopStats:
+    # Shop events are appended to shop_event and folded into per-day and per-week totals by a
+    # background rollup. The rollup moves a watermark over event ids with a conditional update,
+    # so concurrent rollups never count the same event twice. Charts only read the rollup tables.
+    # Events from hot read paths, such as page views, go through the counters write-behind buffer
+    # instead of being written by the request.
+
+    def __init__(self, app=None):
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STATS_ASYNC', True)
+        app.config.setdefault('STATS_ROLLUP_INTERVAL', 30)
+        app.config.setdefault('STATS_ROLLUP_BATCH', 5000)
+        app.config.setdefault('STATS_ROLLUP_LAG', 5)
+
+    def record(self, shop_id, kind, amount=1):
+        if kind not in EVENT_KINDS:
+            raise ValueError(f'Unknown shop event {kind!r}')
+        event = ShopEvent(shop_id=shop_id, kind=kind, amount=amount, created=datetime.utcnow())
+        db.session.add(event)
+        return event
+
+    def record_later(self, shop_id, kind, amount=1):
+        if kind not in EVENT_KINDS:
+            raise ValueError(f'Unknown shop event {kind!r}')
+        # `created` is stamped by the flush, in the transaction that commits the row, so the
+        # STATS_ROLLUP_LAG guard in roll_up_batch holds for buffered events as for recorded ones;
+        # stamped here, a row could already be past the lag before it committed.
+        counters.append(ShopEvent.__table__,
+                        {'shop_id': shop_id, 'kind': kind, 'amount': amount, 'created': datetime.utcnow})
+        # The flush inserts without a session, so the on_commit hook below never sees these rows;
+        # wake the rollup now and let it pick them up once they are flushed.
+        self.wake()
+
+    def _watermark(self):
+        state = RollupState.query.get(ROLLUP)
+        if state is not None:
+            return state.last_event_id
+        try:
+            db.session.add(RollupState(name=ROLLUP, last_event_id=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        return RollupState.query.get(ROLLUP).last_event_id
+
+    def _apply(self, model, totals):
+        for (shop_id, kind, period), (total, count) in totals.items():
+            updated = model.query.filter_by(shop_id=shop_id, kind=kind, period=period)\
+                .update({model.total: model.total + total, model.events: model.events + count},
+                        synchronize_session=False)
+            if not updated:
+                db.session.add(model(shop_id=shop_id, kind=kind, period=period, total=total, events=count))
+
+    def roll_up_batch(self, lag=None):
+        config = current_app.config
+        last = self._watermark()
+        cutoff = datetime.utcnow() - timedelta(seconds=config['STATS_ROLLUP_LAG'] if lag is None else lag)
+        events = ShopEvent.query.with_entities(ShopEvent.id, ShopEvent.shop_id, ShopEvent.kind,
+                                               ShopEvent.amount, ShopEvent.created)\
+            .filter(ShopEvent.id > last).order_by(ShopEvent.id).limit(config['STATS_ROLLUP_BATCH']).all()
+        # Stop at the first event that is still inside the lag window, so an event with a lower
+        # id that commits late is not skipped by the watermark.
+        for index, event in enumerate(events):
+            if event.created > cutoff:
+                events = events[:index]
+                break
+        if not events:
+            return 0
+
+        claimed = RollupState.query.filter_by(name=ROLLUP, last_event_id=last)\
+            .update({'last_event_id': events[-1].id}, synchronize_session=False)
+        if not claimed:
+            db.session.rollback()
+            return 0
+
+        daily = defaultdict(lambda: [0, 0])
+        weekly = defaultdict(lambda: [0, 0])
+        for event in events:
+            day = event.created.date()
+            for totals, period in ((daily, day), (weekly, week_start(day))):
+                entry = totals[(event.shop_id, event.kind, period)]
+                entry[0] += event.amount
+                entry[1] += 1
+        self._apply(ShopDailyStat, daily)
+        self._apply(ShopWeeklyStat, weekly)
+        db.session.commit()
+        return len(events)
+
+    def roll_up(self, lag=None):
+        total = 0
+        while True:
+            count = self.roll_up_batch(lag)
+            total += count
+            if not count:
+                return total
+
+    def rebuild(self):
+        self._watermark()
+        ShopDailyStat.query.delete(synchronize_session=False)
+        ShopWeeklyStat.query.delete(synchronize_session=False)
+        RollupState.query.filter_by(name=ROLLUP).update({'last_event_id': 0}, synchronize_session=False)
+        count = self.roll_up(lag=0)
+        db.session.commit()
+        return count
+
+    def series(self, shop_id, kinds=EVENT_KINDS, period='day', count=30):
+        today = datetime.utcnow().date()
+        if period == 'week':
+            model = ShopWeeklyStat
+            periods = [week_start(today) - timedelta(weeks=i) for i in reversed(range(count))]
+        else:
+            model = ShopDailyStat
+            periods = [today - timedelta(days=i) for i in reversed(range(count))]
+        rows = model.query.with_entities(model.period, model.kind, model.total)\
+            .filter(model.shop_id == shop_id, model.kind.in_(kinds), model.period >= periods[0]).all()
+        values = {(row.period, row.kind): row.total for row in rows}
+        return {'labels': [day.isoformat() for day in periods],
+                'series': {kind: [values.get((day, kind), 0) for day in periods] for kind in kinds}}
+
+    def wake(self):
+        app = current_app._get_current_object()
+        if not app.config['STATS_ASYNC']:
+            # Rollups are left to 'flask stats rollup', e.g. from cron.
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, args=(app,), name='stats-rollup', daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _work(self, app):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Let events accumulate so each rollup folds in a whole interval at once.
+            threading.Event().wait(app.config['STATS_ROLLUP_INTERVAL'])
+            with app.app_context():
+                try:
+                    self.roll_up()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Statistics rollup failed')
+
+
+shop_stats = ShopStats()
+
+
+@on_commit(ShopEvent, key=lambda event: event.shop_id)
+def _events_recorded(shop_ids):
+    shop_stats.wake()
+
+
+@stats_cli.command('rollup')
+def rollup():
+    """Fold new shop events into the daily and weekly rollups."""
+    click.echo(f'Rolled up {shop_stats.roll_up()} events.')
+
+
+@stats_cli.command('rebuild')
+def rebuild():
+    """Recompute the daily and weekly rollups from the raw shop events."""
+    click.echo(f'Rebuilt rollups from {shop_stats.rebuild()} events.')
@@ -0,0 +1,249 @@
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from flask import current_app
+from tribezero.database import primary
+from tribezero.hooks import on_commit
+from tribezero.models import Shop, CompanyAddress
+from tribezero.reference import reference_data
+
+
+SHOP, CITY, CATEGORY = 's', 'c', 'k'
+KIND_NAMES = {SHOP: 'shop', CITY: 'city', CATEGORY: 'category'}
+MAX_LIMIT = 20
+WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    text = (text or '').lower()
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return ' '.join(WORD.findall(text))
+
+
+def prefix_keys(label):
+    # "Green Grocer Dublin" is found by "gre", "groc" and "dub": one key per word start.
+    text = normalize(label)
+    return {text[match.start():] for match in WORD.finditer(text)}
+
+
+class ShopTypeahead:
+    # Sorted array of (key, kind, ident) over shop names, cities and categories; a prefix lookup is
+    # a bisect plus a scan of the matching run. Shops rank by times_viewed, cities and categories
+    # by the views of their shops. Committed shop and address changes are applied incrementally,
+    # and the whole index is rebuilt every TYPEAHEAD_TTL seconds to pick up new view counts; after
+    # the first build that happens on a background thread while the old index keeps answering.
+    # Prefixes matching at least TYPEAHEAD_CACHE_RUN keys keep their ranked answer until one of
+    # those keys or scores changes, so short, popular prefixes don't rescan their run.
+
+    def __init__(self, app=None):
+        self.ttl = 600
+        self.cache_run = 64
+        self._lock = threading.RLock()
+        self._keys = []
+        self._shops = {}
+        self._groups = {CITY: {}, CATEGORY: {}}
+        self._top = {}
+        self._stale = set()
+        self._built_at = None
+        self._bulk = False
+        self._rebuilding = False
+        self._replay = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.setdefault('TYPEAHEAD_TTL', 600)
+        self.cache_run = app.config.setdefault('TYPEAHEAD_CACHE_RUN', 64)
+        app.config.setdefault('TYPEAHEAD_LIMIT', 8)
+
+    def _rows(self, shop_ids=None):
+        query = Shop.query.outerjoin(CompanyAddress, Shop.id == CompanyAddress.shop_id)\
+            .with_entities(Shop.id, Shop.name, Shop.shop_categories, Shop.times_viewed, CompanyAddress.company_city)
+        if shop_ids is not None:
+            query = query.filter(Shop.id.in_(shop_ids))
+        with primary():
+            rows = query.order_by(Shop.id, CompanyAddress.id).all()
+        shops = {}
+        for shop_id, name, category, views, city in rows:
+            shops.setdefault(shop_id, (name, category, city, views or 0))
+        return shops
+
+    def _touch(self, label):
+        if not self._top:
+            return
+        for key in prefix_keys(label):
+            for end in range(1, len(key) + 1):
+                self._top.pop(key[:end], None)
+
+    def _add_keys(self, label, kind, ident):
+        if self._bulk:
+            self._keys.extend((key, kind, ident) for key in prefix_keys(label))
+            return
+        self._touch(label)
+        for key in prefix_keys(label):
+            insort(self._keys, (key, kind, ident))
+
+    def _remove_keys(self, label, kind, ident):
+        self._touch(label)
+        for key in prefix_keys(label):
+            index = bisect_left(self._keys, (key, kind, ident))
+            if index < len(self._keys) and self._keys[index] == (key, kind, ident):
+                del self._keys[index]
+
+    def _group(self, kind, ident, label, views, delta):
+        groups = self._groups[kind]
+        entry = groups.get(ident)
+        if entry is None:
+            entry = groups[ident] = [label, 0, 0]
+            self._add_keys(label, kind, ident)
+        entry[1] += delta
+        entry[2] += views * delta
+        if delta:
+            self._touch(entry[0])
+        if entry[1] <= 0 and kind == CITY:
+            del groups[ident]
+            self._remove_keys(entry[0], kind, ident)
+
+    def _insert_shop(self, shop_id, shop):
+        name, category, city, views = shop
+        self._shops[shop_id] = shop
+        self._add_keys(name, SHOP, shop_id)
+        city_key = normalize(city)
+        if city_key:
+            self._group(CITY, city_key, city, views, 1)
+        if category in self._groups[CATEGORY]:
+            self._group(CATEGORY, category, None, views, 1)
+
+    def _remove_shop(self, shop_id):
+        shop = self._shops.pop(shop_id, None)
+        if shop is None:
+            return
+        name, category, city, views = shop
+        self._remove_keys(name, SHOP, shop_id)
+        city_key = normalize(city)
+        if city_key in self._groups[CITY]:
+            self._group(CITY, city_key, city, views, -1)
+        if category in self._groups[CATEGORY]:
+            self._group(CATEGORY, category, None, views, -1)
+
+    def rebuild(self):
+        shops = self._rows()
+        # Built off to the side with keys appended unsorted and sorted once, then swapped in.
+        fresh = ShopTypeahead()
+        fresh._bulk = True
+        # Every category is suggested, even before it has shops.
+        for code, label in reference_data.categories:
+            fresh._group(CATEGORY, code, label, 0, 0)
+        for shop_id, shop in shops.items():
+            fresh._insert_shop(shop_id, shop)
+        fresh._keys.sort()
+        with self._lock:
+            self._keys, self._shops, self._groups = fresh._keys, fresh._shops, fresh._groups
+            self._top = {}
+            # Changes applied to the old index while this one was loading may be missing from it.
+            self._stale |= self._replay
+            self._replay = set()
+            self._built_at = time.monotonic()
+
+    def _rebuild_in_background(self, app):
+        try:
+            with app.app_context():
+                self.rebuild()
+        except Exception:
+            app.logger.exception('Typeahead rebuild failed')
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def invalidate(self, shop_ids=None):
+        with self._lock:
+            if shop_ids is None:
+                self._built_at = None
+            else:
+                self._stale.update(shop_ids)
+
+    def _refresh(self):
+        with self._lock:
+            if self._built_at is None:
+                self._stale = set()
+                stale = None
+            else:
+                stale, self._stale = self._stale, set()
+                if time.monotonic() - self._built_at > self.ttl and not self._rebuilding:
+                    self._rebuilding = True
+                    threading.Thread(target=self._rebuild_in_background, args=(current_app._get_current_object(),),
+                                     name='typeahead', daemon=True).start()
+                if self._rebuilding:
+                    self._replay |= stale
+        if stale is None:
+            self.rebuild()
+            return
+        if not stale:
+            return
+        shops = self._rows(stale)
+        with self._lock:
+            for shop_id in stale:
+                self._remove_shop(shop_id)
+                if shop_id in shops:
+                    self._insert_shop(shop_id, shops[shop_id])
+
+    def _score(self, ref):
+        kind, ident = ref
+        if kind == SHOP:
+            return self._shops[ident][3]
+        return self._groups[kind][ident][2]
+
+    def _label(self, ref):
+        kind, ident = ref
+        if kind == SHOP:
+            return self._shops[ident][0]
+        return self._groups[kind][ident][0]
+
+    def _matches(self, prefix, limit):
+        top = self._top.get(prefix)
+        if top is not None:
+            return top[:limit]
+        start = bisect_left(self._keys, (prefix,))
+        end = bisect_left(self._keys, (prefix + '\uffff',), start)
+        refs = {key[1:] for key in self._keys[start:end]}
+        cached = end - start >= self.cache_run
+        top = heapq.nlargest(MAX_LIMIT if cached else limit, refs,
+                             key=lambda ref: (self._score(ref), self._label(ref)))
+        if cached:
+            self._top[prefix] = top
+        return top[:limit]
+
+    def suggest(self, query, limit=8):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        limit = min(limit, MAX_LIMIT)
+        self._refresh()
+        with self._lock:
+            refs = self._matches(prefix, limit)
+            results = []
+            for kind, ident in refs:
+                if kind == SHOP:
+                    name, category, city, views = self._shops[ident]
+                    results.append({'type': 'shop', 'id': ident, 'label': name, 'category': category, 'city': city})
+                else:
+                    label, count, views = self._groups[kind][ident]
+                    results.append({'type': KIND_NAMES[kind], 'value': ident, 'label': label, 'shops': count})
+            return results
+
+
+shop_typeahead = ShopTypeahead()
+
+
+@on_commit(Shop)
+def _shops_changed(shop_ids):
+    shop_typeahead.invalidate(shop_ids)
+
+
+@on_commit(CompanyAddress, key=lambda address: address.shop_id)
+def _addresses_changed(shop_ids):
+    shop_typeahead.invalidate(shop_ids)
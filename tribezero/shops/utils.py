@@ -0,0 +1,6 @@
+from sqlalchemy.orm import joinedload
+from tribezero.models import Shop
+
+
+def shop_by_name(name):
+    return Shop.query.options(joinedload(Shop.owner)).filter(Shop.name_lower == name.lower()).first()
@@ -1,23 +1,10 @@
-import json
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, SelectField
+from flask_wtf.file import FileField, FileAllowed, FileRequired
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, SelectField, MultipleFileField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional
 from flask_login import current_user
 from tribezero.models import User, Shop
-
-
-with open('tribezero/static/countries.json', 'r', encoding='utf-8') as f:
-    countries_list_dicts = json.load(f)
-    countries_list = []
-    for country in countries_list_dicts:
-        countries_list.append((country['code'], country['name']))
-
-with open('tribezero/static/shop_categories.json', 'r', encoding='utf-8') as f:
-    shop_categories_dicts = json.load(f)
-    categories_list = []
-    for category in shop_categories_dicts:
-        categories_list.append((category['code'], category['category']))
+from tribezero.reference import reference_data
 
 
 class RegistrationForm(FlaskForm):
@@ -89,14 +76,14 @@ class ResetPasswordForm(FlaskForm):
 
 class CreateShopForm(FlaskForm):
     shop_name = StringField('Shop Name', validators=[DataRequired(), Length(min=4, max=20)])
-    shop_categories = SelectField('Shop Category', choices=categories_list, validators=[DataRequired()])
+    shop_categories = SelectField('Shop Category', validators=[DataRequired()])
     company_name = StringField('Company Name', validators=[DataRequired(), Length(min=4, max=20)])
     paypal = StringField('PayPal Account', validators=[DataRequired(), Email()])
     email = StringField('Email', validators=[DataRequired(), Email()])
     company_street_line1 = StringField('Street Address Line 1', validators=[DataRequired(), Length(min=5)])
     company_street_line2 = StringField('Street Address Line 2')
     company_city = StringField('City', validators=[DataRequired(), Length(min=2)])
-    company_country = SelectField('Country', choices=countries_list, validators=[DataRequired()])
+    company_country = SelectField('Country', validators=[DataRequired()])
     company_region = StringField('Region', validators=[DataRequired(), Length(min=2)])
     company_zip_code = StringField('Zip Code', validators=[DataRequired(), Length(min=3)])
     company_building_number = StringField('Building Number')
@@ -107,8 +94,13 @@ class CreateShopForm(FlaskForm):
     no_vat = BooleanField("I don't have a VAT number.")
     submit = SubmitField('Open Shop')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shop_categories.choices = reference_data.categories
+        self.company_country.choices = reference_data.countries
+
     def validate_shop_name(self, shop_name):
-        shop = Shop.query.filter_by(name=shop_name.data).first()
+        shop = Shop.query.filter_by(name_lower=shop_name.data.lower()).first()
         if shop:
             raise ValidationError('''Unfortunately the tribe already has a shop with that name. 
                                      Please choose a different one.''')
@@ -118,10 +110,18 @@ class CreateShopContinuedForm(FlaskForm):
     billing_street_line1 = StringField('Street Address Line 1', validators=[DataRequired(), Length(min=5, max=100)])
     billing_street_line2 = StringField('Street Address Line 2')
     billing_city = StringField('City', validators=[DataRequired(), Length(min=1, max=100)])
-    billing_country = SelectField('Country', choices=countries_list, validators=[DataRequired()])
+    billing_country = SelectField('Country', validators=[DataRequired()])
     billing_region = StringField('Region', validators=[DataRequired(), Length(min=1, max=100)])
     billing_zip_code = StringField('Zip Code', validators=[DataRequired()])
     billing_building_number = StringField('Building Number', validators=[Optional()])
     billing_apartment_number = StringField('Apartment Number', validators=[Optional()])
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.billing_country.choices = reference_data.countries
+
 
+class ImportListingsForm(FlaskForm):
+    listings_file = FileField('Listings CSV', validators=[FileRequired(), FileAllowed(['csv'])])
+    images = MultipleFileField('Images')
+    submit = SubmitField('Import')
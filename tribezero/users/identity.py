@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.orm import joinedload
+from tribezero import db
+from tribezero.database import primary
+from tribezero.hooks import on_commit
+from tribezero.models import User, Shop
+
+
+class IdentityCache:
+    # Keeps detached, fully loaded User instances (plus the relationships named in
+    # USER_LOADER_EAGER) for USER_CACHE_TTL seconds. load() merges the cached copy into the
+    # request's session with load=False, so resolving current_user costs no query on a hit.
+
+    def __init__(self, app=None):
+        self.max_size = 4096
+        self.ttl = 300
+        self.eager = ()
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self._generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.setdefault('USER_CACHE_SIZE', 4096)
+        self.ttl = app.config.setdefault('USER_CACHE_TTL', 300)
+        self.eager = tuple(app.config.setdefault('USER_LOADER_EAGER', ()))
+
+    def _fetch(self, user_id):
+        session = db.create_session({})()
+        try:
+            query = session.query(User)
+            for relationship in self.eager:
+                query = query.options(joinedload(relationship))
+            with primary():
+                user = query.filter(User.id == user_id).first()
+            session.expunge_all()
+            return user
+        finally:
+            session.close()
+
+    def load(self, user_id):
+        if not self.ttl:
+            return User.query.get(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._users.move_to_end(user_id)
+                user = entry[1]
+            else:
+                user = None
+            generation = self._generation
+
+        if user is None:
+            user = self._fetch(user_id)
+            if user is None:
+                return None
+            with self._lock:
+                if generation == self._generation:
+                    self._users[user_id] = (now + self.ttl, user)
+                    self._users.move_to_end(user_id)
+                    while len(self._users) > self.max_size:
+                        self._users.popitem(last=False)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._users.pop(user_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._generation += 1
+
+
+identity_cache = IdentityCache()
+
+
+@on_commit(User)
+def _users_changed(user_ids):
+    identity_cache.invalidate(user_ids)
+
+
+@on_commit(Shop, key=lambda shop: shop.user_id)
+def _shops_changed(user_ids):
+    if 'shop' in identity_cache.eager:
+        identity_cache.invalidate(user_ids)
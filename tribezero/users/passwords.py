@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import bcrypt as bcrypt_lib
+from werkzeug.exceptions import ServiceUnavailable
+from tribezero.metrics import Histogram, render_histogram, render_metric
+
+
+class HashingOverloaded(ServiceUnavailable):
+    description = 'Too many sign-in requests are being processed. Please try again in a moment.'
+
+
+def _hash(password, rounds):
+    return bcrypt_lib.hashpw(password.encode('utf-8'), bcrypt_lib.gensalt(rounds)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt_lib.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def hash_rounds(pw_hash):
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher:
+    # Runs bcrypt in a process pool so hashing doesn't hold the GIL of the web worker.
+    # At most PASSWORD_HASH_MAX_PENDING hashes may be queued or running; beyond that requests
+    # fail fast with a 503 instead of piling up behind the pool.
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = 0
+        self.max_pending = 8
+        self.timeout = 10
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self.latency = Histogram()
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        self.max_pending = app.config.setdefault('PASSWORD_HASH_MAX_PENDING', max(self.workers, 1) * 4)
+        self.timeout = app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._pending_lock:
+                self.rejected += 1
+            raise HashingOverloaded()
+        with self._pending_lock:
+            self._pending += 1
+        started = time.perf_counter()
+        if not self.workers:
+            try:
+                return function(*args)
+            finally:
+                self._release(started)
+        try:
+            future = self._executor().submit(function, *args)
+        except BaseException:
+            self._release(started)
+            raise
+        # The slot is only given back once the pool is done with the hash, not when this request
+        # stops waiting for it, so a timeout under load can't let more hashes in than the bound.
+        future.add_done_callback(lambda future: self._release(started))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingOverloaded()
+
+    def _release(self, started):
+        self.latency.observe(time.perf_counter() - started)
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        if not pw_hash or not password:
+            return False
+        return self._run(_check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        return hash_rounds(pw_hash) < self.rounds
+
+    def metrics(self):
+        with self._pending_lock:
+            pending, rejected = self._pending, self.rejected
+        return {'queue_depth': pending, 'max_pending': self.max_pending,
+                'rejected': rejected, 'latency': self.latency.snapshot()}
+
+    def render(self):
+        metrics = self.metrics()
+        lines = render_metric('tribezero_password_hash_queue_depth', 'gauge',
+                              'Password hashes queued or running.', [({}, metrics['queue_depth'])])
+        lines += render_metric('tribezero_password_hash_max_pending', 'gauge',
+                               'Password hashes allowed in flight.', [({}, metrics['max_pending'])])
+        lines += render_metric('tribezero_password_hash_rejected_total', 'counter',
+                               'Password hashes refused because the pool was full.', [({}, metrics['rejected'])])
+        lines += render_histogram('tribezero_password_hash_seconds', 'Password hash and check latency.',
+                                  [({}, metrics['latency'])])
+        return lines
+
+
+passwords = PasswordHasher()
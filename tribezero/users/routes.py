@@ -1,22 +1,28 @@
 from flask import render_template, url_for, flash, redirect, request, Blueprint
 from flask_login import login_user, current_user, logout_user, login_required
-from tribezero import db, bcrypt
+from tribezero import db
+from tribezero.database import replica_reads
 from tribezero.models import User, Post
 from tribezero.users.forms import (RegistrationForm, LoginForm, UpdateAccountForm,
                                    RequestResetForm, ResetPasswordForm)
 from tribezero.users.utils import save_picture, send_reset_email
+from tribezero.users.passwords import passwords, HashingOverloaded
+from tribezero.posts.feed import feed_page, post_counts
+from tribezero.images import InvalidImage, image_url
+from tribezero.ratelimit import limiter
 
 
 users = Blueprint('users', __name__)
 
 
 @users.route("/register", methods=['GET', 'POST'])
+@limiter.limit('register', ip='20/hour')
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = passwords.hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
         db.session.add(user)
         db.session.commit()
@@ -26,13 +32,21 @@ def register():
 
 
 @users.route("/login", methods=['GET', 'POST'])
+@limiter.limit('login', ip='30/minute', account='10/5 minutes')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and passwords.check(user.password, form.password.data):
+            if passwords.needs_rehash(user.password):
+                try:
+                    user.password = passwords.hash(form.password.data)
+                    db.session.commit()
+                except HashingOverloaded:
+                    # The password checked out; upgrading its hash can wait for a quieter sign-in.
+                    pass
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('main.home'))
@@ -53,8 +67,11 @@ def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
         if form.picture.data:
-            picture_file = save_picture(form.picture.data)
-            current_user.image_file = picture_file
+            try:
+                current_user.image_file = save_picture(form.picture.data)
+            except InvalidImage as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('users.account'))
         current_user.username = form.username.data
         current_user.email = form.email.data
         db.session.commit()
@@ -63,21 +80,22 @@ def account():
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
+    image_file = image_url('profile', current_user.image_file, 'lg')
     return render_template('account.html', title='Account', image_file=image_file, form=form)
 
 
 @users.route("/user/<string:username>")
+@replica_reads
 def user_posts(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(author=user)\
-        .order_by(Post.date_posted.desc())\
-        .paginate(page=page, per_page=5)
+    user_query = Post.query.filter_by(user_id=user.id)
+    posts = feed_page(user_query, before=request.args.get('before'), after=request.args.get('after'))
+    posts.total = post_counts.get(('user', user.id), user_query)
     return render_template('user_posts.html', posts=posts, user=user)
 
 
 @users.route("/reset_password", methods=['GET', 'POST'])
+@limiter.limit('reset_request', ip='10/hour', account='3/hour')
 def reset_request():
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
@@ -85,12 +103,14 @@ def reset_request():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         send_reset_email(user)
+        db.session.commit()
         flash('An e-mail has been sent with instructions to reset your password.', 'info')
         return redirect(url_for('users.login'))
     return render_template('reset_request.html', title='Reset Password', form=form)
 
 
 @users.route("/reset_password/<token>", methods=['GET', 'POST'])
+@limiter.limit('reset_token', ip='20/hour')
 def reset_token(token):
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
@@ -100,8 +120,7 @@ def reset_token(token):
         return redirect(url_for('users.reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user.password = hashed_password
+        user.password = passwords.hash(form.password.data)
         db.session.commit()
         flash('Your password has been updated!', 'success')
         return redirect(url_for('users.login'))
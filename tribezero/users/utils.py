@@ -1,29 +1,18 @@
-import os
-import secrets
-from PIL import Image
-from flask import url_for, current_app
-from flask_mail import Message
-from tribezero import mail
+from flask import url_for
+from tribezero.images import images
+from tribezero.outbox import outbox
 
 
-def save_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.root_path, 'static/profile_pics', picture_fn)
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-    return picture_fn
+def save_picture(form_picture, kind='profile'):
+    return images.store(form_picture, kind)
 
 
 def send_reset_email(user):
     token = user.get_reset_token()
-    msg = Message('Password Reset Request', sender='noreply@tribezero.com', recipients=[user.email])
-    msg.body = f'''To reset your password, visit the following link:
+    body = f'''To reset your password, visit the following link:
                 {url_for('users.reset_token', token=token, _external=True)}
 
 If you did not make this request, then simply ignore this e-mail and no changes will be made.
 '''
-    mail.send(msg)
\ No newline at end of file
+    outbox.queue('Password Reset Request', [user.email], body, sender='noreply@tribezero.com',
+                 dedupe_key=f'password-reset:{user.id}')
\ No newline at end of file